@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+
+from sentiment_agent.utils import get_simulated_data_by_llm
+
+
+def make_corpus(num_rows, pair_ratio=0.7, seed=1):
+    # 以模拟评论为基础构造指定行数的语料，部分行由两条评论拼接而成，使语料兼有完全重复和不重复的文本
+    base = get_simulated_data_by_llm()['content'].to_numpy(dtype=object)
+    rng = np.random.default_rng(seed)
+    first = base[rng.integers(len(base), size=num_rows)]
+    second = base[rng.integers(len(base), size=num_rows)]
+    paired = rng.random(num_rows) < pair_ratio
+    contents = first.copy()
+    contents[paired] = first[paired] + '，' + second[paired]
+
+    return pd.DataFrame({'content': contents})
@@ -0,0 +1,60 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# import sentiment_agent之后不应加载的依赖，出现时说明有模块在导入阶段引入了重依赖
+HEAVY_MODULES = ['autogen_agentchat', 'autogen_core', 'autogen_ext', 'openai', 'sklearn', 'scipy', 'matplotlib',
+                 'jieba', 'joblib']
+
+STATEMENTS = [
+    'import sentiment_agent',
+    'from sentiment_agent import SentimentAnalysisAgent',
+    'from sentiment_agent import SentimentMultiAgentTeam',
+]
+
+CHILD_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(name for name in {heavy_modules!r} if name in sys.modules)}}))
+'''
+
+
+def measure(statement, repeat):
+    # 每次在新的解释器中导入，避免模块缓存影响结果
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT.format(statement=statement,
+                                                                           heavy_modules=HEAVY_MODULES)],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return statistics.median(run['seconds'] for run in runs), runs[-1]['modules']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sentiment_agent导入耗时基准测试')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=0.5, help='import sentiment_agent耗时中位数的上限（秒）')
+    args = parser.parse_args()
+
+    failed = False
+    for statement in STATEMENTS:
+        seconds, modules = measure(statement, args.repeat)
+        print('{:<55}{:>8.3f}秒  已加载的重依赖：{}'.format(statement, seconds, ', '.join(modules) or '无'))
+        if statement == 'import sentiment_agent':
+            if modules:
+                print('import sentiment_agent不应加载重依赖：{}'.format(', '.join(modules)))
+                failed = True
+            if seconds > args.max_seconds:
+                print('import sentiment_agent耗时{:.3f}秒，超过上限{:.3f}秒'.format(seconds, args.max_seconds))
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
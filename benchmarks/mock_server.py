@@ -0,0 +1,246 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sentiment_agent.batching import estimate_tokens
+
+# 标签总结阶段固定返回的问题标签
+MOCK_LABELS = ['价格欺诈', '卫生问题', '服务态度', '设施老化', '噪音干扰', '安全隐患']
+
+
+def crc(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+class LatencyModel:
+    # 每次请求的响应延迟，distribution为constant、uniform、lognormal或exponential，另加每个输出token的生成耗时
+    def __init__(self, distribution='constant', params=(0.0,), per_token=0.0, seed=1):
+        if distribution not in ('constant', 'uniform', 'lognormal', 'exponential'):
+            raise ValueError("distribution must be 'constant', 'uniform', 'lognormal' or 'exponential', got {!r}".format(
+                distribution))
+        self.distribution = distribution
+        self.params = params
+        self.per_token = per_token
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, per_token=0.0, seed=1):
+        # 例如 constant:0.2、uniform:0.1,0.5、lognormal:0.5,0.4（中位数,sigma）、exponential:0.3（均值）
+        distribution, _, params = spec.partition(':')
+        return cls(distribution, tuple(float(param) for param in params.split(',') if param) or (0.0,), per_token,
+                   seed)
+
+    def sample(self, completion_tokens=0):
+        with self.lock:
+            if self.distribution == 'constant':
+                delay = self.params[0]
+            elif self.distribution == 'uniform':
+                delay = self.rng.uniform(self.params[0], self.params[1])
+            elif self.distribution == 'lognormal':
+                delay = self.params[0] * self.rng.lognormvariate(0, self.params[1])
+            else:
+                delay = self.rng.expovariate(1 / self.params[0]) if self.params[0] else 0.0
+
+        return delay + self.per_token * completion_tokens
+
+
+class MockResponder:
+    # 按系统提示词判断请求来自哪个agent，返回格式正确的确定性回答；
+    # 同一任务内容的首次请求按malformed_rate返回格式错误的回答，重试时返回正确回答，结果与并发顺序无关
+    def __init__(self, malformed_rate=0.0):
+        self.malformed_rate = malformed_rate
+        self.attempts = Counter()
+        self.lock = threading.Lock()
+
+    def is_malformed(self, key):
+        with self.lock:
+            attempt = self.attempts[key]
+            self.attempts[key] += 1
+        return attempt == 0 and crc(key + '<malformed>') % 10000 < self.malformed_rate * 10000
+
+    def respond(self, system, task):
+        # 重试时任务消息前会附加纠错提示，文本内容始终为最后一段
+        content = task.split('\n\n')[-1]
+        malformed = self.is_malformed(system[:50] + content)
+
+        if '情感分析的专家' in system:
+            items = content.split('<sep>')
+            answers = [str(crc(item) % 11) for item in items]
+            num_aspects = re.search(r'对以下(\d+)个问题', system)
+            if num_aspects is not None:
+                # 多问题类型模式下每条文本按问题顺序返回各问题类型的情感分，以<sep0>分隔
+                answers = ['<sep0>'.join(str(crc(item + str(k)) % 11) for k in range(int(num_aspects.group(1))))
+                           for item in items]
+            return self.corrupt(answers, '十', malformed), 'sentiment'
+        if '问题分类的专家' in system:
+            items = content.split('<sep>')
+            labels = sorted(re.findall(r"'(.*?)'", system))
+            answers = [labels[crc(item) % len(labels)] for item in items]
+            return self.corrupt(answers, '未知标签', malformed), 'classification'
+        if '数据占比' in system:
+            lines = [line for line in content.split('\n') if line]
+            return '\n'.join('{}. {}'.format(i + 1, line[:60]) for i, line in enumerate(lines)), 'conclusion'
+        if '问题总结的专家' in system:
+            return '居住质量问题：' + '<sep>'.join(
+                '{}.{}'.format(i + 1, label) for i, label in enumerate(MOCK_LABELS)), 'labels'
+        if '<sep1>' in system:
+            if malformed:
+                return '体验问题：1.卫生差<sep0>2.噪音', 'pre_classification'
+            return '体验问题：1.卫生差<sep0>2.噪音<sep1>推理原因：1.清洁不到位<sep0>2.隔音差', 'pre_classification'
+        if '推理原因' in system:
+            if malformed:
+                return '1.清洁不到位<sep>2.管理松散', 'text_summary'
+            return '推理原因：1.清洁不到位<sep>2.管理松散', 'text_summary'
+
+        return 'ok', 'other'
+
+    def corrupt(self, answers, bad_answer, malformed):
+        if malformed:
+            # 交替产生数量不一致及单条格式错误两类错误，分别触发重新分析及仅对错误文本重试的逻辑
+            if crc('<sep>'.join(answers)) % 2:
+                answers = answers + [answers[-1]]
+            else:
+                answers = [bad_answer] + answers[1:]
+        return '<sep>'.join(answers)
+
+
+class MockServerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'not found'}})
+            return
+
+        server = self.server
+        self.server.stats.add(requests=1)
+        draw = server.rng_draw()
+        if draw < server.rate_limit_rate:
+            server.stats.add(rate_limited=1)
+            self.send_json(429, {'error': {'message': 'rate limited', 'type': 'rate_limit_error'}},
+                           {'Retry-After': str(server.retry_after)})
+            return
+        if draw < server.rate_limit_rate + server.error_rate:
+            server.stats.add(server_errors=1)
+            self.send_json(500, {'error': {'message': 'injected server error', 'type': 'server_error'}})
+            return
+
+        messages = request.get('messages', [])
+        system = next((message['content'] for message in messages if message.get('role') == 'system'), '')
+        task = messages[-1]['content'] if messages else ''
+        content, agent = server.responder.respond(system, task)
+        prompt_tokens = sum(estimate_tokens(str(message.get('content', ''))) for message in messages)
+        completion_tokens = estimate_tokens(content)
+        time.sleep(server.latency.sample(completion_tokens))
+
+        server.stats.add(completions=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                         **{'calls_' + agent: 1})
+        self.send_json(200, {
+            'id': 'chatcmpl-mock-{}'.format(crc(task)),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+
+class MockServer(ThreadingHTTPServer):
+    # 本地OpenAI兼容接口，只实现/v1/chat/completions及用于读取统计的/v1/stats
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, rate_limit_rate=0.0, error_rate=0.0,
+                 malformed_rate=0.0, retry_after=0.5, seed=1):
+        super().__init__((host, port), MockHandler)
+        self.latency = latency or LatencyModel()
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.responder = MockResponder(malformed_rate)
+        self.stats = MockServerStats()
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    def rng_draw(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency', default='lognormal:0.3,0.5',
+                        help='响应延迟分布，例如constant:0.2、uniform:0.1,0.5、lognormal:0.3,0.5、exponential:0.3')
+    parser.add_argument('--latency-per-token', type=float, default=0.0, help='每个输出token额外增加的延迟（秒）')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回429的请求比例')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='429响应的Retry-After（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500的请求比例')
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help='首次请求返回格式错误回答的比例')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def get_server(args, host='127.0.0.1', port=0):
+    return MockServer(host, port, LatencyModel.parse(args.latency, args.latency_per_token, args.seed),
+                      args.rate_limit_rate, args.error_rate, args.malformed_rate, args.retry_after, args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地OpenAI兼容的模拟接口')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = get_server(args, args.host, args.port)
+    print('模拟接口已启动：{}'.format(server.base_url))
+    server.serve_forever()
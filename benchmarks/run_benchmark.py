@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import make_corpus
+from benchmarks.mock_server import add_server_arguments, get_server
+
+# 与各agent的timed_stage名称一致
+STAGES = ['sentiment', 'pre_classification', 'labels', 'classification', 'text_summary', 'conclusion']
+
+
+def run_worker(args, num_rows, base_url):
+    # 在独立子进程中运行，峰值内存只包含本次规模的分析过程
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    from sentiment_agent import SentimentMultiAgentTeam
+
+    df = make_corpus(num_rows, seed=args.seed)
+    source = df
+    if args.chunksize is not None:
+        # 分块模式下语料先写入CSV，再由chunked_run逐块读取，峰值内存不包含完整语料
+        source = os.path.join(tempfile.mkdtemp(prefix='sentiment_agent_bench_'), 'corpus.csv')
+        df.to_csv(source, index=False)
+        del df
+    question_type = args.question_type[0] if len(args.question_type) == 1 else args.question_type
+    team = SentimentMultiAgentTeam(base_url=base_url, api_key='mock', model='mock', domain='酒店',
+                                   question_type=question_type, approval='auto', max_connections=args.max_connections)
+
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if args.quiet:
+            devnull = stack.enter_context(open(os.devnull, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(contextlib.redirect_stderr(devnull))
+        run_kwargs = dict(batch_size=args.batch_size, pre_cluster_num=args.pre_cluster_num,
+                          max_concurrency=args.max_concurrency, token_budget=args.token_budget,
+                          adaptive_batch=args.adaptive_batch, n_jobs=args.n_jobs, dedup=args.dedup,
+                          elbow_method=args.elbow_method, minibatch=args.minibatch)
+        if args.chunksize is None:
+            asyncio.run(team.batch_run(df=source, **run_kwargs))
+        else:
+            asyncio.run(team.chunked_run(source, chunksize=args.chunksize, **run_kwargs))
+            os.remove(source)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'rows': num_rows,
+        'elapsed': elapsed,
+        'rows_per_second': num_rows / elapsed,
+        'stage_times': dict(team.metrics.stage_seconds),
+        'step_times': dict(team.metrics.step_seconds),
+        # Linux下ru_maxrss的单位为KB
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'retry_stats': {name: dict(stats) for name, stats in team.retry_stats().items()},
+        'metrics': team.metrics.to_dict(),
+        'prometheus': team.metrics.to_prometheus(),
+    }
+
+
+def diff_stats(before, after):
+    return {key: after.get(key, 0) - before.get(key, 0) for key in after}
+
+
+def print_result(result):
+    calls = result['server']
+    print('{rows}行：耗时{elapsed:.1f}秒，{rows_per_second:.1f}行/秒，峰值内存{peak_rss_mb:.0f}MB'.format(**result))
+    print('  请求{}次（成功{}次，429 {}次，500 {}次），prompt tokens {}，completion tokens {}'.format(
+        calls.get('requests', 0), calls.get('completions', 0), calls.get('rate_limited', 0),
+        calls.get('server_errors', 0), calls.get('prompt_tokens', 0), calls.get('completion_tokens', 0)))
+    print('  各agent请求次数：' + '，'.join('{} {}'.format(key[len('calls_'):], value)
+                                    for key, value in calls.items() if key.startswith('calls_')))
+    print('  各阶段耗时：' + '，'.join('{} {:.2f}秒'.format(stage, result['stage_times'].get(stage, 0.0))
+                                  for stage in STAGES))
+    print('  预分类本地步骤耗时：' + '，'.join('{} {:.2f}秒'.format(step, seconds)
+                                      for step, seconds in result['step_times'].items()))
+    print('  重试统计：{}'.format(result['retry_stats']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='使用本地模拟接口对SentimentMultiAgentTeam.batch_run进行端到端基准测试')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000], help='语料行数，可指定多个规模')
+    parser.add_argument('--question-type', nargs='+', default=['居住质量'],
+                        help='问题类型，指定多个时使用多问题类型模式')
+    parser.add_argument('--batch-size', type=int, default=30)
+    parser.add_argument('--max-concurrency', type=int, default=32)
+    parser.add_argument('--max-connections', type=int, default=100)
+    parser.add_argument('--pre-cluster-num', type=int, default=20)
+    parser.add_argument('--token-budget', type=int, default=None)
+    parser.add_argument('--adaptive-batch', action='store_true')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--dedup', choices=['exact', 'near'], default=None)
+    parser.add_argument('--elbow-method', default='full')
+    parser.add_argument('--minibatch', action='store_true')
+    parser.add_argument('--chunksize', type=int, default=None, help='指定时使用chunked_run按该行数分块读取语料')
+    parser.add_argument('--quiet', action='store_true', help='不输出分析过程中的打印及进度条')
+    parser.add_argument('--output', default=None, help='将结果以JSON格式写入该文件')
+    parser.add_argument('--prometheus', default=None, help='将最后一个规模的指标以Prometheus文本格式写入该文件')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = get_server(args).start()
+    print('模拟接口已启动：{}'.format(server.base_url))
+    results = []
+    try:
+        for num_rows in args.rows:
+            before = server.stats.snapshot()
+            # 每个规模使用新的子进程，避免上一规模的内存占用影响峰值内存统计
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_worker, args, num_rows, server.base_url).result()
+            result['server'] = diff_stats(before, server.stats.snapshot())
+            results.append(result)
+            print_result(result)
+    finally:
+        server.shutdown()
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.prometheus is not None and results:
+        with open(args.prometheus, 'w', encoding='utf-8') as file:
+            file.write(results[-1]['prometheus'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,36 @@
+import importlib
+
 __version__ = "0.1.0"
 
 
-__all__ = ["SentimentAnalysisAgent", "TextPreClassificationAgent", "TextClassificationAgent", "TextSummaryAgent", 'ConclusionSummaryAgent', "SentimentMultiAgentTeam"]
+__all__ = ["SentimentAnalysisAgent", "TextPreClassificationAgent", "TextClassificationAgent", "TextSummaryAgent", 'ConclusionSummaryAgent', "SentimentMultiAgentTeam",
+           "SQLiteCacheStore", "SQLiteCheckpointStore", "SentimentTriage",
+           "ClassificationTriage", "Metrics"]
+
+
+# 各名称在首次访问时才导入对应子模块，import sentiment_agent不会加载autogen、scikit-learn、jieba等依赖
+_lazy_imports = {
+    "SentimentAnalysisAgent": ".sentiment_analysis",
+    "TextPreClassificationAgent": ".text_pre_classification",
+    "TextClassificationAgent": ".text_classification",
+    "TextSummaryAgent": ".text_summary",
+    "ConclusionSummaryAgent": ".conclusion_summary",
+    "SentimentMultiAgentTeam": ".multi_agent_team",
+    "SQLiteCacheStore": ".cache",
+    "SQLiteCheckpointStore": ".checkpoint",
+    "SentimentTriage": ".triage",
+    "ClassificationTriage": ".triage",
+    "Metrics": ".metrics",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
-from .sentiment_analysis import SentimentAnalysisAgent
-from .text_pre_classification import TextPreClassificationAgent
-from .text_classification import TextClassificationAgent
-from .text_summary import TextSummaryAgent
-from .conclusion_summary import ConclusionSummaryAgent
-from .multi_agent_team import SentimentMultiAgentTeam
\ No newline at end of file
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,234 @@
+import asyncio
+import re
+from collections import Counter
+
+import numpy as np
+from autogen_core import CancellationToken
+from tqdm.asyncio import tqdm_asyncio
+
+from .dedup import find_duplicates
+
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    # 中文字符按约1个token估计，其余字符按约4个字符1个token估计
+    cjk_num = len(CJK_PATTERN.findall(text))
+    return cjk_num + (len(text) - cjk_num) // 4 + 1
+
+
+def truncate_text(text, max_tokens):
+    # 按与estimate_tokens一致的估计方式截断文本，使其token数不超过max_tokens
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    token_num = np.cumsum([1 if CJK_PATTERN.match(char) else 0.25 for char in text])
+    return text[:int(np.searchsorted(token_num, max_tokens - 1, side='right'))]
+
+
+class AdaptiveBatcher:
+    def __init__(self, positions, token_counts=None, batch_size=30, token_budget=None, adaptive=False,
+                 min_batch_size=1, max_batch_size=None, growth_rate=0.1, shrink_rate=0.5):
+        self.positions = positions
+        self.token_counts = token_counts
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.adaptive = adaptive
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size if max_batch_size is not None else batch_size * 4
+        self.growth_rate = growth_rate
+        self.shrink_rate = shrink_rate
+        self.cursor = 0
+        self.clean_num = 0
+        self.error_num = 0
+
+    def next_batch(self):
+        if self.cursor >= len(self.positions):
+            return None
+
+        if self.token_budget is None or self.adaptive:
+            limit = int(self.batch_size)
+        else:
+            # 设置token预算时按预算打包短文本，条数只受max_batch_size限制；自适应模式下仍由batch_size控制条数
+            limit = int(self.max_batch_size)
+        end = min(self.cursor + limit, len(self.positions))
+        if self.token_budget is not None:
+            # 按估计token数打包，保证单个batch不超过token预算，且至少包含1条文本
+            cumulative_tokens = np.cumsum(self.token_counts[self.cursor: end])
+            end = self.cursor + max(1, int(np.searchsorted(cumulative_tokens, self.token_budget, side='right')))
+
+        batch = self.positions[self.cursor: end]
+        self.cursor = end
+        return batch
+
+    def update(self, clean):
+        # 加性增、乘性减：解析顺利时逐步增大batch，出现数量或格式错误时快速减小batch
+        if clean:
+            self.clean_num += 1
+        else:
+            self.error_num += 1
+
+        if not self.adaptive:
+            return
+
+        if clean:
+            self.batch_size = min(self.max_batch_size, self.batch_size + max(1.0, self.batch_size * self.growth_rate))
+        else:
+            self.batch_size = max(self.min_batch_size, self.batch_size * self.shrink_rate)
+
+
+class BatchAnalysisMixin:
+    # 情感分析与文本分类共用的分批调度、重试及拆分逻辑。子类提供parse_answer、count_prompt、format_prompt、
+    # format_error、failed_answer及record_retry，parse_answer对无效的回答返回None
+    format_error = 'format_error'
+
+    async def dispatch_batches(self, contents, results, agent, get_agent, stage, desc, report_name, batch_size=30,
+                               max_concurrency=1, token_budget=None, prompt_tokens=0, output_tokens=0,
+                               adaptive_batch=False, checkpoint=None, dedup=None, dedup_report=True, n_jobs=1,
+                               tokenize_cache=None, triage=None, get_features=None, on_complete=None):
+        # 结果就地写入results，待分析的行为空字符串；返回去重分组，未去重时返回None
+        if checkpoint is not None:
+            # 从断点恢复已完成batch的结果，只对剩余文本进行分析
+            done = checkpoint.load_rows(stage)
+            results[list(done.keys())] = list(done.values())
+        pending_positions = np.flatnonzero(results == '')
+        num_pending = len(pending_positions)
+        duplicate_groups = None
+        if dedup is not None:
+            # 重复及近似重复文本只发送每组的代表文本，结果再写回组内所有文本
+            duplicate_groups = find_duplicates(contents, pending_positions, dedup, n_jobs=n_jobs,
+                                               tokenize_cache=tokenize_cache)
+            if dedup_report:
+                duplicate_groups.report(report_name)
+            pending_positions = duplicate_groups.representatives
+
+        pbar = tqdm_asyncio(total=num_pending, desc="{} complete progress".format(desc))
+
+        def complete(positions):
+            if not len(positions):
+                return
+            if duplicate_groups is not None:
+                positions = duplicate_groups.fan_out(results, positions)
+            pbar.update(len(positions))
+            if checkpoint is not None:
+                checkpoint.save_rows(stage, positions, results[positions])
+            if on_complete is not None:
+                on_complete(positions)
+
+        async def analyze(positions):
+            token_counts = None
+            budget = None
+            if token_budget is not None:
+                # 每条文本的token估计值包含分隔符及输出，预算扣除系统消息占用的token
+                token_counts = np.array([estimate_tokens(text) for text in contents[positions]],
+                                        dtype=np.int64) + output_tokens
+                budget = token_budget - prompt_tokens
+            batcher = AdaptiveBatcher(positions, token_counts, batch_size=batch_size, token_budget=budget,
+                                      adaptive=adaptive_batch)
+
+            # 每个worker持有独立的AssistantAgent，避免并发请求共享同一对话上下文
+            async def worker(worker_agent):
+                while True:
+                    positions = batcher.next_batch()
+                    if positions is None:
+                        break
+                    retry_stats = Counter()
+                    results[positions] = await self.run_batch(contents[positions], positions[0], positions[-1] + 1,
+                                                              worker_agent, retry_stats)
+                    batcher.update(not retry_stats)
+                    complete(positions)
+
+            num_workers = max(1, min(max_concurrency, -(-len(positions) // batch_size)))
+            agents = [agent] + [get_agent() for _ in range(num_workers - 1)]
+            await asyncio.gather(*[worker(worker_agent) for worker_agent in agents])
+
+        if triage is not None:
+            features = contents if get_features is None else get_features(pending_positions)
+            if not triage.fitted:
+                # 本地模型尚未训练时，先由大模型分析种子样本并以此训练
+                seed_positions = triage.sample_seed(pending_positions)
+                await analyze(seed_positions)
+                triage.fit(features[seed_positions], results[seed_positions])
+                triage.num_llm += len(seed_positions)
+                pending_positions = np.setdiff1d(pending_positions, seed_positions)
+
+            # 本地模型高置信度的文本直接给出结果，其余文本交由大模型分析
+            local_results, confident = triage.predict(features[pending_positions])
+            results[pending_positions[confident]] = local_results[confident]
+            complete(pending_positions[confident])
+            pending_positions = pending_positions[~confident]
+            triage.num_local += int(confident.sum())
+            triage.num_llm += len(pending_positions)
+            triage.report()
+
+        await analyze(pending_positions)
+        pbar.close()
+
+        return duplicate_groups
+
+    async def run_batch(self, texts, start_index, end_index, agent, retry_stats=None):
+        # 无状态模式下每次调用只保留系统消息、本次任务及其重试反馈，避免对话历史随batch累积
+        if self.stateless:
+            await agent.on_reset(CancellationToken())
+        results = [''] * len(texts)
+        pending = list(range(len(texts)))
+        num_prompt = ''
+        format_prompt = ''
+
+        for _ in range(self.max_attempts):
+            task_message = "<sep>".join([texts[j] for j in pending])
+
+            result = await self.metrics.run_agent(agent, task='\n\n'.join([num_prompt, format_prompt, task_message]))
+
+            response = result.messages[-1].content
+
+            input_num = len(pending)
+            answers = response.strip().strip('<sep>').split('<sep>')
+            output_num = len(answers)
+            if output_num != input_num:
+                self.record_retry('count_mismatch', retry_stats)
+                num_prompt = self.count_prompt.format(output_num=output_num, input_num=input_num)
+                print(
+                    "第{}-{}行的分析存在输出数量{}与输入数量{}不一致错误，将重新进行分析，若多次失败，建议减少batch_size的值以提升模型性能。".format(
+                        start_index, end_index - 1, output_num, input_num))
+                print(response)
+                continue
+
+            # 保留有效的结果，仅对无效的位置重新提问
+            invalid = []
+            for j, answer in zip(pending, answers):
+                parsed = self.parse_answer(answer)
+                if parsed is not None:
+                    results[j] = parsed
+                else:
+                    invalid.append(j)
+
+            if invalid:
+                self.record_retry(self.format_error, retry_stats)
+                format_prompt = self.format_prompt
+                print("第{}-{}行的分析存在{}条无效结果，将仅对这些文本重新进行分析。".format(
+                    start_index, end_index - 1, len(invalid)))
+                print(response)
+                pending = invalid
+                continue
+
+            pending = []
+            break
+
+        if len(pending) == 1:
+            self.record_retry('failed_rows', retry_stats)
+            results[pending[0]] = self.failed_answer
+            print("第{}-{}行中有1条文本多次分析失败，已标记为分析失败。".format(start_index, end_index - 1))
+
+        elif len(pending) > 1:
+            # 达到最大重试次数后将剩余文本二分，分别重新分析，直至定位到无法解析的单条文本
+            self.record_retry('bisect', retry_stats)
+            print("第{}-{}行的分析多次失败，将剩余{}条文本拆分为两个batch重新进行分析。".format(
+                start_index, end_index - 1, len(pending)))
+            middle = len(pending) // 2
+            for half in [pending[:middle], pending[middle:]]:
+                half_results = await self.run_batch([texts[j] for j in half], start_index + half[0],
+                                                    start_index + half[-1] + 1, agent, retry_stats)
+                for j, answer in zip(half, half_results):
+                    results[j] = answer
+
+        return results
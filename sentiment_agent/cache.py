@@ -0,0 +1,65 @@
+import os
+import pickle
+import sqlite3
+import time
+
+from autogen_core import CacheStore
+
+
+class SQLiteCacheStore(CacheStore):
+    def __init__(self, path, max_entries=None, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.num_sets = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)')
+        self.connection.commit()
+        self.evict()
+
+    def get(self, key, default=None):
+        row = self.connection.execute('SELECT value, created_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.max_age is not None and time.time() - row[1] > self.max_age):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)',
+                                (key, pickle.dumps(value), time.time()))
+        self.connection.commit()
+        self.num_sets += 1
+        # 定期淘汰，避免每次写入都扫描全表
+        if self.num_sets % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        if self.max_age is not None:
+            self.connection.execute('DELETE FROM cache WHERE created_at < ?', (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self.connection.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM cache')
+        self.connection.commit()
+
+    def stats(self):
+        entries = self.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                'entries': entries}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,85 @@
+import os
+import pickle
+import sqlite3
+
+
+class SQLiteCheckpointStore:
+    def __init__(self, path):
+        self.path = path
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # rows保存各阶段逐batch完成的结果，frames保存各阶段完成后的中间结果
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rows (stage TEXT NOT NULL, key INTEGER NOT NULL, value BLOB NOT NULL, '
+            'PRIMARY KEY (stage, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS frames (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.commit()
+
+    def start(self, run_key):
+        # 输入数据或分析配置变化时，已有的断点不再适用，清空后重新开始
+        row = self.connection.execute("SELECT value FROM meta WHERE name = 'run_key'").fetchone()
+        if row is not None and row[0] != run_key:
+            print("输入数据或分析配置与断点记录不一致，将清空断点并重新开始分析")
+            self.clear()
+        elif row is not None:
+            print("检测到断点记录，将跳过已完成的阶段和batch")
+        self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('run_key', ?)", (run_key,))
+        self.connection.commit()
+
+    def save_rows(self, stage, keys, values):
+        self.connection.executemany('INSERT OR REPLACE INTO rows (stage, key, value) VALUES (?, ?, ?)',
+                                    [(stage, int(key), pickle.dumps(value)) for key, value in zip(keys, values)])
+        self.connection.commit()
+
+    def load_rows(self, stage):
+        return {key: pickle.loads(value) for key, value in
+                self.connection.execute('SELECT key, value FROM rows WHERE stage = ?', (stage,))}
+
+    def save_frame(self, name, value):
+        self.connection.execute('INSERT OR REPLACE INTO frames (name, value) VALUES (?, ?)',
+                                (name, pickle.dumps(value)))
+        self.connection.commit()
+
+    def load_frame(self, name, default=None):
+        row = self.connection.execute('SELECT value FROM frames WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def has_frame(self, name):
+        return self.connection.execute('SELECT 1 FROM frames WHERE name = ?', (name,)).fetchone() is not None
+
+    def clear(self):
+        self.connection.execute('DELETE FROM rows')
+        self.connection.execute('DELETE FROM frames')
+        self.connection.execute('DELETE FROM meta')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class CheckpointNamespace:
+    # 多问题类型模式下各子团队共用同一个断点，阶段及中间结果名称加上问题类型前缀，互不覆盖
+    def __init__(self, checkpoint, namespace):
+        self.checkpoint = checkpoint
+        self.prefix = '{}/'.format(namespace)
+
+    def save_rows(self, stage, keys, values):
+        self.checkpoint.save_rows(self.prefix + stage, keys, values)
+
+    def load_rows(self, stage):
+        return self.checkpoint.load_rows(self.prefix + stage)
+
+    def save_frame(self, name, value):
+        self.checkpoint.save_frame(self.prefix + name, value)
+
+    def load_frame(self, name, default=None):
+        return self.checkpoint.load_frame(self.prefix + name, default)
+
+    def has_frame(self, name):
+        return self.checkpoint.has_frame(self.prefix + name)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+FILE_FORMATS = {'.csv': 'csv', '.txt': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.jsonl': 'jsonl',
+                '.json': 'jsonl'}
+
+
+def get_file_format(path, file_format=None):
+    if file_format is None:
+        file_format = FILE_FORMATS.get(os.path.splitext(str(path))[1].lower())
+    if file_format not in ('csv', 'parquet', 'jsonl'):
+        raise ValueError("file_format must be 'csv', 'parquet' or 'jsonl', got {!r}".format(file_format))
+    return file_format
+
+
+def iter_chunks(source, chunksize=100000, file_format=None, columns=None):
+    # source可以是文件路径、DataFrame或DataFrame的迭代器，按chunksize行逐块返回，每块的索引为全局行号
+    if isinstance(source, (str, os.PathLike)):
+        chunks = read_file_chunks(source, chunksize, get_file_format(source, file_format), columns)
+    elif isinstance(source, pd.DataFrame):
+        chunks = (source.iloc[start:start + chunksize] for start in range(0, len(source), chunksize))
+    else:
+        chunks = iter(source)
+
+    offset = 0
+    for chunk in chunks:
+        if columns is not None:
+            chunk = chunk[columns]
+        chunk = chunk.set_axis(pd.RangeIndex(offset, offset + len(chunk)))
+        offset += len(chunk)
+        yield chunk
+
+
+def read_file_chunks(path, chunksize, file_format, columns=None):
+    if file_format == 'csv':
+        yield from pd.read_csv(path, chunksize=chunksize, usecols=columns)
+    elif file_format == 'jsonl':
+        yield from pd.read_json(path, lines=True, chunksize=chunksize)
+    else:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("reading Parquet files requires pyarrow, install it with `pip install pyarrow`") \
+                from error
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+
+class DataFrameSpill:
+    # 将逐块得到的DataFrame依次写入磁盘，全部写入后再一次性读回，未指定spill_dir时使用临时目录并在读回后删除
+    def __init__(self, spill_dir=None):
+        self.temporary = spill_dir is None
+        self.spill_dir = tempfile.mkdtemp(prefix='sentiment_agent_spill_') if spill_dir is None else spill_dir
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.paths = []
+        self.num_rows = 0
+
+    def append(self, df):
+        path = os.path.join(self.spill_dir, 'part-{:05d}.pkl'.format(len(self.paths)))
+        df.to_pickle(path)
+        self.paths.append(path)
+        self.num_rows += len(df)
+
+    def load(self):
+        frames = [pd.read_pickle(path) for path in self.paths]
+        self.cleanup()
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def cleanup(self):
+        if self.temporary:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        else:
+            for path in self.paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.paths = []
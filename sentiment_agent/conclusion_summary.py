@@ -1,39 +1,50 @@
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core import CancellationToken
+
+from .map_reduce import AgentPool, chunk_by_tokens, map_reduce
+from .metrics import Metrics, timed_stage
+from .model_client import get_model_client, get_model_context
 
 
 class ConclusionSummaryAgent:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, model_client=None, map_reduce=False, chunk_token_budget=2000, reduce_fan_out=4,
+                 reduce_max_depth=3, metrics=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
-        self.model_client = OpenAIChatCompletionClient(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            model=self.model,
-            temperature=0,
-            model_info={
-                "vision": True,
-                "function_calling": True,
-                "json_output": False,
-                "family": ModelFamily.R1,
-                "structured_output": True,
-            },
-        )
-        self.conclusion_summary_agent = AssistantAgent(
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.metrics = metrics or Metrics()
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store)
+        self.map_reduce = map_reduce
+        self.chunk_token_budget = chunk_token_budget
+        self.reduce_fan_out = reduce_fan_out
+        self.reduce_max_depth = reduce_max_depth
+        self.system_message = """你是一个{domain}领域{question_type}问题总结的专家，给定{question_type}问题和文本内容，请总结用户在{domain}领域主要存在的{question_type}问题，确保按{question_type}问题的占比进行重要性降序排列，输出结果需要包含三类信息：{question_type}问题、数据占比和具体问题描述。
+                                    """.format(domain=self.domain, question_type=self.question_type)
+        # map-reduce模式下合并各部分总结时使用的提示
+        self.reduce_prompt = "以下为分别针对部分{question_type}问题得到的多份总结，请合并为一份完整的总结，数据占比保持不变：".format(
+            question_type=self.question_type)
+        self.conclusion_summary_agent = self.get_conclusion_summary_agent()
+
+    def get_conclusion_summary_agent(self):
+        return AssistantAgent(
             name="conclusion_summary_agent",
             model_client=self.model_client,
-            system_message="""你是一个{domain}领域{question_type}问题总结的专家，给定{question_type}问题和文本内容，请总结用户在{domain}领域主要存在的{question_type}问题，确保按{question_type}问题的占比进行重要性降序排列，输出结果需要包含三类信息：{question_type}问题、数据占比和具体问题描述。
-                                    """.format(domain=self.domain, question_type=self.question_type),
+            model_context=get_model_context(self.buffer_size),
+            system_message=self.system_message,
         )
 
-    async def batch_run(self, classified_summary):
+    @timed_stage('conclusion')
+    async def batch_run(self, classified_summary, max_concurrency=1):
         self.conclusion_summary = classified_summary.copy()
 
-        task_message = "\n".join((
+        task_lines = (
                 "{question_type}问题为：".format(question_type=self.question_type)
                 + self.conclusion_summary["class"]
                 + "此问题的数据占比"
@@ -43,9 +54,28 @@ class ConclusionSummaryAgent:
                 + "%，"
                 + "{question_type}问题的具体描述为：".format(question_type=self.question_type)
                 + self.conclusion_summary["推理原因"]
-        ))
+        ).tolist()
+
+        if not self.map_reduce:
+            return await self.run("\n".join(task_lines))
+
+        # 问题标签较多时按token预算将各标签分块并发总结，再逐层合并各部分总结
+        num_workers = max(1, min(max_concurrency, len(chunk_by_tokens(task_lines, self.chunk_token_budget))))
+        agent_pool = AgentPool([self.conclusion_summary_agent] + [self.get_conclusion_summary_agent() for _ in
+                                                                  range(num_workers - 1)])
+
+        return await map_reduce(
+            task_lines,
+            lambda lines: agent_pool.run(self.run, "\n".join(lines)),
+            lambda partials: agent_pool.run(self.run, "\n\n".join([self.reduce_prompt] + partials)),
+            self.chunk_token_budget, self.reduce_fan_out, self.reduce_max_depth)
+
+    async def run(self, task_message, agent=None):
+        agent = agent or self.conclusion_summary_agent
+        if self.stateless:
+            await agent.on_reset(CancellationToken())
 
-        result = await self.conclusion_summary_agent.run(task=task_message)
+        result = await self.metrics.run_agent(agent, task=task_message)
         self.messages = result.messages
 
         return self.messages[-1].content
@@ -0,0 +1,109 @@
+import hashlib
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from .utils import chinese_preprocess_batch
+
+NORMALIZE_PATTERN = re.compile(r'[\s\W_]+')
+
+
+def normalize_text(text):
+    # 全半角、大小写、空白及标点差异不影响文本含义，统一后再比较
+    return NORMALIZE_PATTERN.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+def simhash(words, bits=64):
+    counts = Counter(words)
+    hashes = np.array([int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'little') for word in counts],
+                      dtype=np.uint64)
+    weights = np.array(list(counts.values()), dtype=np.int64)
+    hash_bits = (hashes[:, None] >> np.arange(bits, dtype=np.uint64)) & np.uint64(1)
+    vector = (np.where(hash_bits == 1, 1, -1) * weights[:, None]).sum(axis=0)
+
+    return int(np.sum((vector > 0).astype(np.uint64) << np.arange(bits, dtype=np.uint64)))
+
+
+class DuplicateGroups:
+    def __init__(self, positions, group_index):
+        # group_index[i]为positions[i]所在组的代表文本在positions中的下标，代表文本为组内第一条
+        self.positions = positions
+        self.group_index = group_index
+        self.representatives = positions[np.unique(group_index)]
+        order = np.argsort(group_index, kind='stable')
+        group_sizes = np.bincount(group_index)[np.unique(group_index)]
+        self.members = dict(zip(self.representatives, np.split(positions[order], np.cumsum(group_sizes)[:-1])))
+
+    @property
+    def dedup_ratio(self):
+        if not len(self.positions):
+            return 0.0
+        return 1 - len(self.representatives) / len(self.positions)
+
+    def fan_out(self, values, positions):
+        # 将代表文本的结果写回组内所有文本，返回展开后的全部行位置
+        expanded = np.concatenate([self.members[position] for position in positions])
+        values[expanded] = np.repeat(values[positions], [len(self.members[position]) for position in positions])
+        return expanded
+
+    def report(self, name):
+        print("{}去重：{}条待分析文本合并为{}组，仅对每组的代表文本进行分析，去重比例{:.2%}".format(
+            name, len(self.positions), len(self.representatives), self.dedup_ratio))
+
+
+def find_duplicates(texts, positions, method='exact', hamming_distance=3, min_words=5, n_jobs=1,
+                    tokenize_cache=None):
+    if method not in ('exact', 'near'):
+        raise ValueError("method must be 'exact' or 'near', got {!r}".format(method))
+
+    # 完全重复：归一化文本的哈希值相同
+    first_index = {}
+    group_index = np.empty(len(positions), dtype=np.int64)
+    for i, text in enumerate(texts[positions]):
+        key = hashlib.md5(normalize_text(text).encode('utf-8')).digest()
+        group_index[i] = first_index.setdefault(key, i)
+
+    if method == 'near':
+        group_index = merge_near_duplicates(texts, positions, group_index, hamming_distance, min_words, n_jobs,
+                                            tokenize_cache)
+
+    return DuplicateGroups(positions, group_index)
+
+
+def merge_near_duplicates(texts, positions, group_index, hamming_distance, min_words, n_jobs, tokenize_cache):
+    # 近似重复：对各组代表文本的分词结果计算SimHash，汉明距离不超过hamming_distance的文本合并为一组
+    candidates = np.unique(group_index)
+    corpus = chinese_preprocess_batch(texts[positions[candidates]], n_jobs=n_jobs, tokenize_cache=tokenize_cache)
+    # 词数过少时SimHash区分度不足，只做完全重复合并
+    fingerprints = {candidate: simhash(words.split()) for candidate, words in zip(candidates, corpus) if
+                    len(words.split()) >= min_words}
+
+    parent = {candidate: candidate for candidate in fingerprints}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # 将64位指纹分为hamming_distance+1段，汉明距离不超过阈值的两条指纹至少有一段完全相同，只比较同一分段桶内的候选
+    num_bands = hamming_distance + 1
+    band_bits = 64 // num_bands
+    band_mask = (1 << band_bits) - 1
+    buckets = defaultdict(list)
+    for candidate, fingerprint in fingerprints.items():
+        for band in range(num_bands):
+            buckets[(band, (fingerprint >> (band * band_bits)) & band_mask)].append(candidate)
+
+    for bucket in buckets.values():
+        for i, left in enumerate(bucket):
+            for right in bucket[i + 1:]:
+                if find(left) != find(right) and bin(fingerprints[left] ^ fingerprints[right]).count('1') <= hamming_distance:
+                    left_root, right_root = find(left), find(right)
+                    parent[max(left_root, right_root)] = min(left_root, right_root)
+
+    roots = np.array([find(i) if i in parent else i for i in group_index], dtype=np.int64)
+
+    return roots
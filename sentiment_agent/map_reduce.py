@@ -0,0 +1,71 @@
+import asyncio
+
+from .batching import estimate_tokens
+
+
+def chunk_by_tokens(texts, token_budget):
+    # 按token预算将文本依次切分为若干块，每块至少包含一条文本
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for text in texts:
+        text_tokens = estimate_tokens(text) + 1
+        if chunk and chunk_tokens + text_tokens > token_budget:
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(text)
+        chunk_tokens += text_tokens
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+class AgentPool:
+    # 多个map-reduce任务共享的agent池，同时进行的请求数不超过池中agent的数量
+    def __init__(self, agents):
+        self.agents = asyncio.Queue()
+        for agent in agents:
+            self.agents.put_nowait(agent)
+
+    async def run(self, fn, *args, **kwargs):
+        agent = await self.agents.get()
+        try:
+            return await fn(*args, agent=agent, **kwargs)
+        finally:
+            self.agents.put_nowait(agent)
+
+
+async def pass_through(partial):
+    return partial
+
+
+def group_partials(partials, token_budget, fan_out=None):
+    # 按token预算将部分结果分组，fan_out不为None时每组最多fan_out个；
+    # 若每组都只剩一个部分结果（单个结果已超过预算的一半），则按fan_out或两两分组，保证每层结果数减少
+    groups = []
+    for chunk in chunk_by_tokens(partials, token_budget):
+        step = fan_out or len(chunk)
+        groups.extend(chunk[i:i + step] for i in range(0, len(chunk), step))
+    if len(groups) == len(partials):
+        step = fan_out or 2
+        groups = [partials[i:i + step] for i in range(0, len(partials), step)]
+
+    return groups
+
+
+async def map_reduce(texts, map_fn, reduce_fn, token_budget, fan_out=4, max_depth=3):
+    # map阶段并发总结各文本块；reduce阶段在token预算内每fan_out个部分结果合并一次，逐层合并直至只剩一个结果，
+    # 达到max_depth层后不再限制每组数量，每次合并token预算内尽可能多的部分结果
+    chunks = chunk_by_tokens(texts, token_budget) or [[]]
+    partials = await asyncio.gather(*[map_fn(chunk) for chunk in chunks])
+    depth = 0
+    while len(partials) > 1:
+        depth += 1
+        groups = group_partials(partials, token_budget, fan_out if depth < max_depth else None)
+        # 只剩一个部分结果的分组无需合并，直接进入下一层
+        partials = await asyncio.gather(*[reduce_fn(group) if len(group) > 1 else pass_through(group[0])
+                                          for group in groups])
+
+    return partials[0]
@@ -0,0 +1,166 @@
+import functools
+import json
+import logging
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+# 大模型调用耗时直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # 最后一个桶对应+Inf
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(bucket) for bucket in self.buckets] + ['+Inf'], self.cumulative_counts()))}
+
+
+class Metrics:
+    # 所有agent共享同一个Metrics，按agent名称记录每次调用的耗时、token用量及各类重试次数，另记录各阶段及本地计算步骤的耗时
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.call_latency = defaultdict(lambda: Histogram(self.buckets))
+        self.tokens = Counter()
+        self.retries = Counter()
+        self.stage_seconds = Counter()
+        self.step_seconds = Counter()
+
+    async def run_agent(self, agent, task):
+        start = time.perf_counter()
+        result = await agent.run(task=task)
+        self.record_call(agent.name, time.perf_counter() - start, result.messages)
+        return result
+
+    def record_call(self, agent_name, seconds, messages):
+        self.call_latency[agent_name].observe(seconds)
+        for message in messages:
+            # 只有模型生成的消息带有models_usage，用户任务消息为None
+            usage = getattr(message, 'models_usage', None)
+            if usage is not None:
+                self.tokens[(agent_name, 'prompt')] += usage.prompt_tokens
+                self.tokens[(agent_name, 'completion')] += usage.completion_tokens
+
+    def record_retry(self, agent_name, retry_type):
+        self.retries[(agent_name, retry_type)] += 1
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += time.perf_counter() - start
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.step_seconds[name] += time.perf_counter() - start
+
+    def reset(self):
+        self.__init__(self.buckets)
+
+    def to_dict(self):
+        return {
+            'calls': {agent_name: histogram.to_dict() for agent_name, histogram in self.call_latency.items()},
+            'tokens': {'{}.{}'.format(*key): value for key, value in self.tokens.items()},
+            'retries': {'{}.{}'.format(*key): value for key, value in self.retries.items()},
+            'stage_seconds': dict(self.stage_seconds),
+            'step_seconds': dict(self.step_seconds),
+        }
+
+    def to_records(self):
+        records = []
+        for agent_name, histogram in self.call_latency.items():
+            records.append({'metric': 'call_latency_seconds', 'agent': agent_name, 'count': histogram.count,
+                            'sum': histogram.sum})
+        for (agent_name, token_type), value in self.tokens.items():
+            records.append({'metric': 'tokens', 'agent': agent_name, 'type': token_type, 'value': value})
+        for (agent_name, retry_type), value in self.retries.items():
+            records.append({'metric': 'retries', 'agent': agent_name, 'type': retry_type, 'value': value})
+        for stage, value in self.stage_seconds.items():
+            records.append({'metric': 'stage_seconds', 'stage': stage, 'value': value})
+        for step, value in self.step_seconds.items():
+            records.append({'metric': 'step_seconds', 'step': step, 'value': value})
+        return records
+
+    def log(self, log=None):
+        # 结构化日志：每条指标输出一行JSON
+        log = log or logger
+        for record in self.to_records():
+            log.info(json.dumps(record, ensure_ascii=False))
+
+    def to_prometheus(self, prefix='sentiment_agent'):
+        lines = ['# HELP {}_call_latency_seconds LLM call latency per agent.'.format(prefix),
+                 '# TYPE {}_call_latency_seconds histogram'.format(prefix)]
+        for agent_name, histogram in self.call_latency.items():
+            for bucket, count in zip([str(bucket) for bucket in histogram.buckets] + ['+Inf'],
+                                     histogram.cumulative_counts()):
+                lines.append('{}_call_latency_seconds_bucket{{agent="{}",le="{}"}} {}'.format(prefix, agent_name,
+                                                                                           bucket, count))
+            lines.append('{}_call_latency_seconds_sum{{agent="{}"}} {}'.format(prefix, agent_name, histogram.sum))
+            lines.append('{}_call_latency_seconds_count{{agent="{}"}} {}'.format(prefix, agent_name, histogram.count))
+
+        lines += ['# HELP {}_tokens_total Prompt and completion tokens reported by the model.'.format(prefix),
+                  '# TYPE {}_tokens_total counter'.format(prefix)]
+        lines += ['{}_tokens_total{{agent="{}",type="{}"}} {}'.format(prefix, agent_name, token_type, value)
+                  for (agent_name, token_type), value in self.tokens.items()]
+
+        lines += ['# HELP {}_retries_total Retries by failure type.'.format(prefix),
+                  '# TYPE {}_retries_total counter'.format(prefix)]
+        lines += ['{}_retries_total{{agent="{}",type="{}"}} {}'.format(prefix, agent_name, retry_type, value)
+                  for (agent_name, retry_type), value in self.retries.items()]
+
+        lines += ['# HELP {}_stage_seconds Wall time per stage.'.format(prefix),
+                  '# TYPE {}_stage_seconds gauge'.format(prefix)]
+        lines += ['{}_stage_seconds{{stage="{}"}} {}'.format(prefix, stage, value)
+                  for stage, value in self.stage_seconds.items()]
+
+        lines += ['# HELP {}_step_seconds Wall time of local computation steps.'.format(prefix),
+                  '# TYPE {}_step_seconds gauge'.format(prefix)]
+        lines += ['{}_step_seconds{{step="{}"}} {}'.format(prefix, step, value)
+                  for step, value in self.step_seconds.items()]
+
+        return '\n'.join(lines) + '\n'
+
+
+def timed_stage(name):
+    # 记录agent或团队方法的耗时；流式模式下同一阶段可能多次调用且相互重叠，耗时按调用累加
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name):
+                return await method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_step(metrics, name):
+    return nullcontext() if metrics is None else metrics.step(name)
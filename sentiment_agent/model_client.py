@@ -0,0 +1,192 @@
+import asyncio
+import random
+import time
+
+import httpx
+from autogen_core import CacheStore
+from autogen_core.model_context import BufferedChatCompletionContext
+from autogen_core.models import ChatCompletionClient, ModelFamily
+from autogen_ext.models.cache import ChatCompletionCache
+from autogen_ext.models.openai import OpenAIChatCompletionClient
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from .batching import estimate_tokens
+
+
+class ModelCacheStore(CacheStore):
+    # ChatCompletionCache的缓存键只包含消息内容，这里加上模型名称，避免切换模型后命中其他模型的回答
+    def __init__(self, cache_store, model):
+        self.cache_store = cache_store
+        self.model = model
+
+    def get(self, key, default=None):
+        return self.cache_store.get('{}:{}'.format(self.model, key), default)
+
+    def set(self, key, value):
+        self.cache_store.set('{}:{}'.format(self.model, key), value)
+
+
+class RateLimiter:
+    # 令牌桶限流，同时限制每分钟请求数和每分钟token数，为None时不限制
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute or 0
+        self.available_tokens = tokens_per_minute or 0
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.requests_per_minute is not None:
+            self.available_requests = min(self.requests_per_minute,
+                                          self.available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self.available_tokens = min(self.tokens_per_minute,
+                                        self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens=0):
+        async with self.lock:
+            while True:
+                self.refill()
+                wait_seconds = 0
+                if self.requests_per_minute is not None and self.available_requests < 1:
+                    wait_seconds = (1 - self.available_requests) * 60 / self.requests_per_minute
+                if self.tokens_per_minute is not None:
+                    tokens = min(tokens, self.tokens_per_minute)
+                    if self.available_tokens < tokens:
+                        wait_seconds = max(wait_seconds,
+                                           (tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+                if wait_seconds <= 0:
+                    break
+                await asyncio.sleep(wait_seconds)
+
+            if self.requests_per_minute is not None:
+                self.available_requests -= 1
+            if self.tokens_per_minute is not None:
+                self.available_tokens -= tokens
+
+    def adjust(self, tokens):
+        # 请求完成后按实际用量修正预估的token数
+        if self.tokens_per_minute is not None:
+            self.available_tokens -= tokens
+
+
+class RateLimitedChatCompletionClient(ChatCompletionClient):
+    def __init__(self, client, rate_limiter=None, max_retries=5, backoff=1.0, max_backoff=60.0):
+        self.client = client
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.num_rate_limited = 0
+
+    def get_backoff(self, attempt, error):
+        # 连接错误没有response
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        try:
+            return min(self.max_backoff, float(retry_after))
+        except (TypeError, ValueError):
+            return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def create(self, messages, *, tools=[], tool_choice="auto", json_output=None, extra_create_args={},
+                     cancellation_token=None):
+        estimated_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                result = await self.client.create(messages, tools=tools, tool_choice=tool_choice,
+                                                  json_output=json_output, extra_create_args=extra_create_args,
+                                                  cancellation_token=cancellation_token)
+            except RateLimitError as error:
+                self.num_rate_limited += 1
+                if attempt == self.max_retries:
+                    raise
+                backoff = self.get_backoff(attempt, error)
+                print("请求触发限流(429)，将在{:.1f}秒后进行第{}次重试".format(backoff, attempt + 1))
+                await asyncio.sleep(backoff)
+                continue
+            except (InternalServerError, APIConnectionError) as error:
+                # 服务端错误及连接错误同样退避后重试，与SDK默认的重试范围一致
+                if attempt == self.max_retries:
+                    raise
+                backoff = self.get_backoff(attempt, error)
+                print("请求失败({})，将在{:.1f}秒后进行第{}次重试".format(type(error).__name__, backoff, attempt + 1))
+                await asyncio.sleep(backoff)
+                continue
+
+            self.rate_limiter.adjust(result.usage.prompt_tokens + result.usage.completion_tokens - estimated_tokens)
+            return result
+
+    async def create_stream(self, messages, *, tools=[], tool_choice="auto", json_output=None, extra_create_args={},
+                            cancellation_token=None):
+        await self.rate_limiter.acquire(sum(estimate_tokens(str(message.content)) for message in messages))
+        async for chunk in self.client.create_stream(messages, tools=tools, tool_choice=tool_choice,
+                                                     json_output=json_output, extra_create_args=extra_create_args,
+                                                     cancellation_token=cancellation_token):
+            yield chunk
+
+    async def close(self):
+        await self.client.close()
+
+    def actual_usage(self):
+        return self.client.actual_usage()
+
+    def total_usage(self):
+        return self.client.total_usage()
+
+    def count_tokens(self, messages, *, tools=[]):
+        return self.client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages, *, tools=[]):
+        return self.client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self):
+        return self.client.capabilities
+
+    @property
+    def model_info(self):
+        return self.client.model_info
+
+
+def get_model_client(base_url, api_key, model, cache_store=None, rate_limiter=None, max_connections=None,
+                     max_retries=5):
+    client_kwargs = {}
+    if max_connections is not None:
+        # 多个agent共享同一个客户端时，通过连接池上限复用HTTP连接
+        client_kwargs['http_client'] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+    model_client = OpenAIChatCompletionClient(
+        base_url=base_url,
+        api_key=api_key,
+        model=model,
+        temperature=0,
+        # 429、5xx及连接错误由RateLimitedChatCompletionClient统一退避重试，关闭SDK自身的重试，避免绕过团队级限流并叠加重试次数
+        max_retries=0,
+        model_info={
+            "vision": True,
+            "function_calling": True,
+            "json_output": False,
+            "family": ModelFamily.R1,
+            "structured_output": True,
+        },
+        **client_kwargs,
+    )
+    model_client = RateLimitedChatCompletionClient(model_client, rate_limiter, max_retries=max_retries)
+    if cache_store is not None:
+        # 缓存位于限流之外，命中缓存的请求不占用限流额度
+        model_client = ChatCompletionCache(model_client, ModelCacheStore(cache_store, model))
+
+    return model_client
+
+
+def get_model_context(buffer_size=None):
+    # buffer_size为None时使用AssistantAgent默认的无界上下文，否则只保留最近buffer_size条消息
+    if buffer_size is None:
+        return None
+
+    return BufferedChatCompletionContext(buffer_size=buffer_size)
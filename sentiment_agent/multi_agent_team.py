@@ -1,77 +1,592 @@
+import asyncio
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .checkpoint import CheckpointNamespace
+from .chunking import DataFrameSpill, iter_chunks
 from .conclusion_summary import ConclusionSummaryAgent
+from .metrics import Metrics, timed_stage
+from .model_client import RateLimiter, get_model_client
 from .sentiment_analysis import SentimentAnalysisAgent
 from .text_classification import TextClassificationAgent
 from .text_pre_classification import TextPreClassificationAgent
 from .text_summary import TextSummaryAgent
+from .utils import chinese_preprocess_batch, fit_tfidf, pre_classified_predict, resolve_n_jobs
+
+
+def get_aspect_path(path, aspect):
+    # 多问题类型模式下各子团队的文件路径在扩展名前加上问题类型，避免相互覆盖
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, aspect, ext)
 
 
 class SentimentMultiAgentTeam:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+    # 各阶段完成后写入断点的中间结果
+    checkpoint_frames = ('sentiment_df', 'negative_sentiment_df', 'pre_classified_df', 'pre_classified_summary',
+                         'class_labels', 'classified_df', 'classified_summary', 'conclusion_summary')
+
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, max_attempts=3, requests_per_minute=None, tokens_per_minute=None,
+                 max_connections=100, approval='input', approval_callback=None, approval_file=None,
+                 approval_timeout=None, class_labels=None, map_reduce=False, chunk_token_budget=2000, reduce_fan_out=4,
+                 reduce_max_depth=3, max_chunks=16, metrics=None, model_client=None, approval_lock=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.max_attempts = max_attempts
+        self.checkpoint = None
+        # 所有agent共享同一个Metrics，记录各阶段耗时、每次调用的耗时与token用量及各类重试次数
+        self.metrics = metrics or Metrics()
+        # 所有agent共享同一个客户端，限流器统一控制整个团队的每分钟请求数和token数
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store, self.rate_limiter, max_connections)
+        agent_kwargs = dict(base_url=self.base_url, api_key=self.api_key, model=self.model, domain=self.domain,
+                            question_type=self.question_type, cache_store=self.cache_store,
+                            stateless=self.stateless, buffer_size=self.buffer_size, model_client=self.model_client,
+                            metrics=self.metrics)
         self.multi_agent_team = {}
-        self.multi_agent_team['SentimentAnalysisAgent'] = SentimentAnalysisAgent(base_url=self.base_url,
-                                                                                 api_key=self.api_key,
-                                                                                 model=self.model, domain=self.domain,
-                                                                                 question_type=self.question_type)
-
-        self.multi_agent_team['TextPreClassificationAgent'] = TextPreClassificationAgent(base_url=self.base_url,
-                                                                                         api_key=self.api_key,
-                                                                                         model=self.model,
-                                                                                         domain=self.domain,
-                                                                                         question_type=self.question_type)
-
-        self.multi_agent_team['TextClassificationAgent'] = TextClassificationAgent(base_url=self.base_url,
-                                                                                   api_key=self.api_key,
-                                                                                   model=self.model, domain=self.domain,
-                                                                                   question_type=self.question_type)
-
-        self.multi_agent_team['TextSummaryAgent'] = TextSummaryAgent(base_url=self.base_url, api_key=self.api_key,
-                                                                     model=self.model,
-                                                                     domain=self.domain,
-                                                                     question_type=self.question_type)
-        self.multi_agent_team['ConclusionSummaryAgent'] = ConclusionSummaryAgent(base_url=self.base_url,
-                                                                                 api_key=self.api_key,
-                                                                                 model=self.model,
-                                                                                 domain=self.domain,
-                                                                                 question_type=self.question_type)
+        self.multi_agent_team['SentimentAnalysisAgent'] = SentimentAnalysisAgent(**agent_kwargs,
+                                                                                 max_attempts=self.max_attempts)
+        self.aspect_teams = {}
+        if not isinstance(question_type, str):
+            # 多问题类型模式：情感分析一次调用完成所有问题类型的打分，各问题类型的负向文本交由独立的子团队完成后续阶段，
+            # 子团队共用客户端、限流器与Metrics；class_labels可按问题类型以字典形式提供
+            approval_lock = asyncio.Lock()
+            for aspect in question_type:
+                self.aspect_teams[aspect] = SentimentMultiAgentTeam(
+                    self.base_url, self.api_key, self.model, self.domain, aspect, cache_store=self.cache_store,
+                    stateless=self.stateless, buffer_size=self.buffer_size, max_attempts=self.max_attempts,
+                    approval=approval, approval_callback=approval_callback,
+                    approval_file=get_aspect_path(approval_file, aspect), approval_timeout=approval_timeout,
+                    class_labels=class_labels.get(aspect) if isinstance(class_labels, dict) else class_labels,
+                    map_reduce=map_reduce, chunk_token_budget=chunk_token_budget, reduce_fan_out=reduce_fan_out,
+                    reduce_max_depth=reduce_max_depth, max_chunks=max_chunks, metrics=self.metrics,
+                    model_client=self.model_client, approval_lock=approval_lock)
+            return
+
+        self.multi_agent_team['TextPreClassificationAgent'] = TextPreClassificationAgent(**agent_kwargs)
+        self.multi_agent_team['TextClassificationAgent'] = TextClassificationAgent(
+            **agent_kwargs, max_attempts=self.max_attempts, approval=approval, approval_callback=approval_callback,
+            approval_file=approval_file, approval_timeout=approval_timeout, class_labels=class_labels,
+            approval_lock=approval_lock)
+        summary_kwargs = dict(map_reduce=map_reduce, chunk_token_budget=chunk_token_budget,
+                              reduce_fan_out=reduce_fan_out, reduce_max_depth=reduce_max_depth)
+        self.multi_agent_team['TextSummaryAgent'] = TextSummaryAgent(**agent_kwargs, **summary_kwargs,
+                                                                     max_chunks=max_chunks)
+        self.multi_agent_team['ConclusionSummaryAgent'] = ConclusionSummaryAgent(**agent_kwargs, **summary_kwargs)
 
+    @timed_stage('batch_run')
     async def batch_run(self, df, batch_size=30, content_col='content', sentiment_col='score', pre_cluster_num=20,
-                        classified_col='class'):
-        self.sentiment_df = df.copy()
-        self.sentiment_df[sentiment_col] = ''
+                        classified_col='class', max_concurrency=1, token_budget=None, adaptive_batch=False,
+                        n_jobs=1, tokenize_cache=None, elbow_method='full', minibatch=False, checkpoint=None,
+                        dedup=None, dedup_report=True, triage=None,
+                        classification_triage=None, plot_path=None):
+        # n_jobs在入口处解析一次，之后各阶段使用相同的进程数
+        n_jobs = resolve_n_jobs(n_jobs)
+        if self.aspect_teams and classification_triage is not None:
+            raise ValueError("classification_triage is not supported when question_type is a list")
+        self.start_checkpoint(checkpoint, df, content_col, pre_cluster_num, elbow_method, minibatch)
+        if tokenize_cache is None and dedup == 'near':
+            # 近似去重的分词结果在预分类阶段直接复用
+            tokenize_cache = {}
+
+        if not self.stage_done('sentiment_df'):
+            sentiment_df = df.copy()
+            sentiment_df[sentiment_col] = ''
+
+            print('SentimentAnalysisAgent starts working...')
+            sentiment_df = await self.multi_agent_team['SentimentAnalysisAgent'].batch_run(
+                sentiment_df=sentiment_df,
+                batch_size=batch_size,
+                content_col=content_col,
+                sentiment_col=sentiment_col,
+                max_concurrency=max_concurrency,
+                token_budget=token_budget,
+                adaptive_batch=adaptive_batch,
+                checkpoint=self.checkpoint,
+                dedup=dedup,
+                dedup_report=dedup_report,
+                n_jobs=n_jobs,
+                tokenize_cache=tokenize_cache,
+                triage=triage)
+            if self.aspect_teams:
+                # 各问题类型的负向文本在后续阶段中按各自的情感分列筛选
+                self.save_frames(sentiment_df=sentiment_df)
+            else:
+                self.save_frames(sentiment_df=sentiment_df,
+                                 negative_sentiment_df=sentiment_df[
+                                     sentiment_df[sentiment_col].astype('float64') <= 3].reset_index().copy())
+
+        if self.aspect_teams:
+            return await self.classify_and_summarize_aspects(batch_size, content_col, sentiment_col, pre_cluster_num,
+                                                             classified_col, max_concurrency, token_budget,
+                                                             adaptive_batch, n_jobs, tokenize_cache, elbow_method,
+                                                             minibatch, dedup, dedup_report, plot_path)
+        return await self.classify_and_summarize(batch_size, content_col, sentiment_col, pre_cluster_num,
+                                                 classified_col, max_concurrency, token_budget, adaptive_batch,
+                                                 n_jobs, tokenize_cache, elbow_method, minibatch, dedup, dedup_report,
+                                                 classification_triage, plot_path)
+
+    async def classify_and_summarize(self, batch_size, content_col, sentiment_col, pre_cluster_num, classified_col,
+                                     max_concurrency, token_budget, adaptive_batch, n_jobs, tokenize_cache,
+                                     elbow_method, minibatch, dedup=None, dedup_report=True,
+                                     classification_triage=None, plot_path=None, tfidf=None):
+        if not self.stage_done('pre_classified_summary'):
+            print('TextPreClassificationAgent starts working...')
+            pre_classified_summary = await self.multi_agent_team['TextPreClassificationAgent'].batch_run(
+                negative_sentiment_df=self.negative_sentiment_df, content_col=content_col,
+                pre_cluster_num=pre_cluster_num, n_jobs=n_jobs, tokenize_cache=tokenize_cache,
+                elbow_method=elbow_method, minibatch=minibatch, max_concurrency=max_concurrency,
+                plot_path=plot_path, checkpoint=self.checkpoint, tfidf=tfidf)
+            self.save_frames(pre_classified_df=self.multi_agent_team['TextPreClassificationAgent'].pre_classified_df,
+                             pre_classified_summary=pre_classified_summary)
+
+        if not self.stage_done('classified_df'):
+            print('TextClassificationAgent starts working...')
+            if not self.stage_done('class_labels'):
+                await self.multi_agent_team['TextClassificationAgent'].summary2label(self.pre_classified_summary)
+                self.save_frames(class_labels=self.multi_agent_team['TextClassificationAgent'].class_labels)
+            else:
+                # 断点中已有人工确认的问题标签，不再重复总结
+                self.multi_agent_team['TextClassificationAgent'].set_class_labels(self.class_labels)
+            self.pre_classified_df[classified_col] = ''
+            self.share_vectorizer(classification_triage)
+            classified_df = await self.multi_agent_team['TextClassificationAgent'].batch_run(
+                self.pre_classified_df,
+                batch_size=batch_size,
+                content_col=content_col,
+                classified_col=classified_col,
+                max_concurrency=max_concurrency,
+                token_budget=token_budget,
+                adaptive_batch=adaptive_batch,
+                checkpoint=self.checkpoint,
+                dedup=dedup,
+                dedup_report=dedup_report,
+                n_jobs=n_jobs,
+                tokenize_cache=tokenize_cache,
+                triage=classification_triage)
+            self.save_frames(classified_df=classified_df)
+
+        return await self.summarize(content_col, sentiment_col, classified_col, max_concurrency)
+
+    async def classify_and_summarize_aspects(self, batch_size, content_col, sentiment_col, pre_cluster_num,
+                                             classified_col, max_concurrency, token_budget, adaptive_batch, n_jobs,
+                                             tokenize_cache, elbow_method, minibatch, dedup=None, dedup_report=True,
+                                             plot_path=None):
+        score_cols = self.multi_agent_team['SentimentAnalysisAgent'].get_score_columns(sentiment_col)
+        negative = self.sentiment_df[score_cols].astype('float64') <= 3
+        # 同一条文本可能在多个问题类型下均为负向，分词只进行一次；TF-IDF在任一问题类型为负向的全部文本上拟合后共用
+        tokenize_cache = {} if tokenize_cache is None else tokenize_cache
+        tfidf = await asyncio.to_thread(fit_tfidf, self.sentiment_df.loc[negative.any(axis=1), content_col], n_jobs,
+                                        tokenize_cache, self.metrics)
+
+        async def run_aspect(aspect, score_col):
+            aspect_team = self.aspect_teams[aspect]
+            aspect_team.start_checkpoint(None, None, content_col, pre_cluster_num, elbow_method, minibatch)
+            if self.checkpoint is not None:
+                aspect_team.checkpoint = CheckpointNamespace(self.checkpoint, aspect)
+            aspect_team.negative_sentiment_df = self.sentiment_df[negative[score_col]].drop(
+                columns=[col for col in score_cols if col != score_col]).rename(
+                columns={score_col: sentiment_col}).reset_index()
+            print('问题类型{}：负向文本{}行'.format(aspect, len(aspect_team.negative_sentiment_df)))
+            return await aspect_team.classify_and_summarize(batch_size, content_col, sentiment_col, pre_cluster_num,
+                                                            classified_col, max_concurrency, token_budget,
+                                                            adaptive_batch, n_jobs, tokenize_cache, elbow_method,
+                                                            minibatch, dedup, dedup_report,
+                                                            plot_path=get_aspect_path(plot_path, aspect), tfidf=tfidf)
+
+        # 各问题类型的后续阶段相互独立，并发执行
+        results = await asyncio.gather(*[run_aspect(aspect, score_col) for aspect, score_col in
+                                         zip(self.aspect_teams, score_cols)])
+        return dict(zip(self.aspect_teams, results))
+
+    async def summarize(self, content_col, sentiment_col, classified_col, max_concurrency):
+        if not self.stage_done('classified_summary'):
+            print('TextSummary starts working...')
+            classified_summary = await self.multi_agent_team['TextSummaryAgent'].batch_run(
+                self.classified_df, content_col, sentiment_col, classified_col, max_concurrency=max_concurrency,
+                checkpoint=self.checkpoint, tfidf=getattr(self.multi_agent_team['TextPreClassificationAgent'], 'tfidf',
+                                                          None))
+            self.save_frames(classified_summary=classified_summary)
+
+        if not self.stage_done('conclusion_summary'):
+            print('ConclusionSummaryAgent starts working...')
+            conclusion_summary = await self.multi_agent_team['ConclusionSummaryAgent'].batch_run(
+                self.classified_summary, max_concurrency)
+            self.save_frames(conclusion_summary=conclusion_summary)
+
+        return [self.pre_classified_summary, self.classified_df, self.classified_summary, self.conclusion_summary]
+
+    @timed_stage('chunked_run')
+    async def chunked_run(self, source, batch_size=30, content_col='content', sentiment_col='score', pre_cluster_num=20,
+                          classified_col='class', max_concurrency=1, token_budget=None, adaptive_batch=False,
+                          n_jobs=1, tokenize_cache=None, elbow_method='full', minibatch=False, dedup=None,
+                          dedup_report=True, triage=None, classification_triage=None, plot_path=None,
+                          chunksize=100000, file_format=None, columns=None, spill_dir=None):
+        n_jobs = resolve_n_jobs(n_jobs)
+        if self.aspect_teams:
+            raise ValueError("chunked_run does not support a list of question types, use batch_run instead")
+        # 输入按chunksize行逐块读取并进行情感分析，内存中只保留各行的Int8情感分，负向文本逐块写入磁盘，
+        # 情感分析结束后只读回负向文本进行后续阶段
+        # 分块模式不支持断点，清除上一次运行留下的断点及中间结果
+        self.start_checkpoint(None, None, content_col, pre_cluster_num, elbow_method, minibatch)
+        sentiment_agent = self.multi_agent_team['SentimentAnalysisAgent']
+        spill = DataFrameSpill(spill_dir)
+        scores = []
+        try:
+            print('SentimentAnalysisAgent starts working in chunked mode...')
+            for chunk in iter_chunks(source, chunksize, file_format, columns):
+                sentiment_df = chunk.copy()
+                sentiment_df[sentiment_col] = ''
+                sentiment_df = await sentiment_agent.batch_run(
+                    sentiment_df=sentiment_df, batch_size=batch_size, content_col=content_col,
+                    sentiment_col=sentiment_col, max_concurrency=max_concurrency, token_budget=token_budget,
+                    adaptive_batch=adaptive_batch, dedup=dedup, dedup_report=dedup_report, n_jobs=n_jobs,
+                    tokenize_cache=tokenize_cache, triage=triage)
+                scores.append(sentiment_df[sentiment_col])
+                # reset_index后的index列为全局行号，与batch_run中负向文本的index列一致
+                spill.append(sentiment_df[sentiment_df[sentiment_col].astype('float64') <= 3].reset_index())
+            print('情感分析完成：共{}行，其中负向文本{}行'.format(sum(map(len, scores)), spill.num_rows))
+            self.sentiment_scores = pd.concat(scores, ignore_index=True) if scores else pd.Series(dtype='Int8')
+            self.negative_sentiment_df = spill.load()
+        finally:
+            spill.cleanup()
+
+        return await self.classify_and_summarize(batch_size, content_col, sentiment_col, pre_cluster_num,
+                                                 classified_col, max_concurrency, token_budget, adaptive_batch,
+                                                 n_jobs, tokenize_cache, elbow_method, minibatch, dedup, dedup_report,
+                                                 classification_triage, plot_path)
+
+    @timed_stage('incremental_run')
+    async def incremental_run(self, df, state_path, batch_size=30, content_col='content', sentiment_col='score',
+                              pre_cluster_num=20, classified_col='class', max_concurrency=1, token_budget=None,
+                              adaptive_batch=False, n_jobs=1, tokenize_cache=None, elbow_method='full', id_col=None,
+                              drift_threshold=0.3, dedup=None, dedup_report=True, triage=None,
+                              classification_triage=None):
+        n_jobs = resolve_n_jobs(n_jobs)
+        if self.aspect_teams:
+            raise ValueError("incremental_run does not support a list of question types, use batch_run instead")
+        state = self.load_incremental_state(state_path)
+        if state is None:
+            # 首次运行时完整执行一遍，聚类使用支持partial_fit的MiniBatchKMeans，并保存模型、标签与累计统计
+            print('未找到增量状态，将对全部数据完整运行一次')
+            result_list = await self.batch_run(df, batch_size=batch_size, content_col=content_col,
+                                               sentiment_col=sentiment_col, pre_cluster_num=pre_cluster_num,
+                                               classified_col=classified_col, max_concurrency=max_concurrency,
+                                               token_budget=token_budget, adaptive_batch=adaptive_batch,
+                                               n_jobs=n_jobs, tokenize_cache=tokenize_cache,
+                                               elbow_method=elbow_method, minibatch=True, dedup=dedup,
+                                               dedup_report=dedup_report, triage=triage,
+                                               classification_triage=classification_triage)
+            pre_classification_agent = self.multi_agent_team['TextPreClassificationAgent']
+            state = {'tfidf': pre_classification_agent.tfidf, 'kmeans': pre_classification_agent.kmeans,
+                     'class_labels': self.multi_agent_team['TextClassificationAgent'].class_labels,
+                     'pre_classified_summary': self.pre_classified_summary, 'class_counts': {}, 'score_sums': {},
+                     'reasons': dict(zip(self.classified_summary[classified_col], self.classified_summary['推理原因'])),
+                     'seen_ids': set(df[id_col]) if id_col is not None else set(), 'cluster_counts': {},
+                     'cluster_score_sums': {}}
+            self.update_aggregates(state, self.classified_df, sentiment_col, classified_col)
+            self.update_cluster_aggregates(state, self.pre_classified_df, sentiment_col)
+            self.save_incremental_state(state_path, state)
+            self.label_drift = False
+            return result_list
+
+        if id_col is not None:
+            # 只分析之前未处理过的行
+            df = df[~df[id_col].isin(state['seen_ids'])]
+        print('增量模式：本次新增{}条文本'.format(len(df)))
 
         print('SentimentAnalysisAgent starts working...')
+        self.sentiment_df = df.copy()
+        self.sentiment_df[sentiment_col] = ''
         self.sentiment_df = await self.multi_agent_team['SentimentAnalysisAgent'].batch_run(
-            sentiment_df=self.sentiment_df,
-            batch_size=batch_size,
-            content_col=content_col,
-            sentiment_col=sentiment_col)
+            sentiment_df=self.sentiment_df, batch_size=batch_size, content_col=content_col,
+            sentiment_col=sentiment_col, max_concurrency=max_concurrency, token_budget=token_budget,
+            adaptive_batch=adaptive_batch, dedup=dedup, dedup_report=dedup_report, n_jobs=n_jobs,
+            tokenize_cache=tokenize_cache, triage=triage)
         self.negative_sentiment_df = self.sentiment_df[
             self.sentiment_df[sentiment_col].astype('float64') <= 3].reset_index().copy()
 
-        print('TextPreClassificationAgent starts working...')
-        self.pre_classified_summary = await self.multi_agent_team['TextPreClassificationAgent'].batch_run(
-            negative_sentiment_df=self.negative_sentiment_df, content_col=content_col, pre_cluster_num=pre_cluster_num)
-        self.pre_classified_df = self.multi_agent_team['TextPreClassificationAgent'].pre_classified_df
+        # 新增负向文本沿用已保存的TF-IDF与聚类模型分配簇，并以partial_fit更新聚类中心
+        with self.metrics.step('pre_classified_predict'):
+            if len(self.negative_sentiment_df):
+                self.pre_classified_df = pre_classified_predict(self.negative_sentiment_df, content_col,
+                                                                state['tfidf'], state['kmeans'], n_jobs, tokenize_cache)
+            else:
+                self.pre_classified_df = self.negative_sentiment_df.assign(corpus='', cluster=0)
+        with self.metrics.step('kmeans_partial_fit'):
+            if len(self.pre_classified_df) >= state['kmeans'].n_clusters:
+                state['kmeans'].partial_fit(state['tfidf'].transform(self.pre_classified_df['corpus']))
+        self.update_cluster_aggregates(state, self.pre_classified_df, sentiment_col)
+        self.pre_classified_summary = self.get_cumulative_pre_classified_summary(state, sentiment_col)
         self.pre_classified_df[classified_col] = ''
 
         print('TextClassificationAgent starts working...')
-        await self.multi_agent_team['TextClassificationAgent'].summary2label(self.pre_classified_summary)
-        self.classified_df = await self.multi_agent_team['TextClassificationAgent'].batch_run(self.pre_classified_df,
-                                                                                              batch_size=batch_size,
-                                                                                              content_col=content_col,
-                                                                                              classified_col=classified_col)
+        classification_agent = self.multi_agent_team['TextClassificationAgent']
+        classification_agent.set_class_labels(state['class_labels'])
+        self.classified_df = await classification_agent.batch_run(
+            self.pre_classified_df, batch_size=batch_size, content_col=content_col, classified_col=classified_col,
+            max_concurrency=max_concurrency, token_budget=token_budget, adaptive_batch=adaptive_batch, dedup=dedup,
+            dedup_report=dedup_report, n_jobs=n_jobs, tokenize_cache=tokenize_cache, triage=classification_triage)
 
+        # 新增文本中归入其他问题的占比过高时，说明已有标签不再覆盖新的问题；分类失败的文本不计入
+        new_labels = self.classified_df[classified_col].dropna()
+        other_share = (new_labels == classification_agent.other_label).mean() if len(new_labels) else 0.0
+        self.label_drift = other_share > drift_threshold
+        if self.label_drift:
+            print("新增负向文本中{}的占比为{:.2%}，超过阈值{:.2%}，问题标签可能已不适用，建议重新完整运行batch_run确认标签".format(
+                classification_agent.other_label, other_share, drift_threshold))
+
+        self.update_aggregates(state, self.classified_df, sentiment_col, classified_col)
+        if id_col is not None:
+            state['seen_ids'].update(df[id_col])
+
+        # 问题标签汇总按累计数量计算，只对首次出现的标签补充推理原因
+        classified_summary = pd.DataFrame({classified_col: list(state['class_counts'].keys()),
+                                           'count': list(state['class_counts'].values())})
+        classified_summary['percentage'] = classified_summary['count'] / classified_summary['count'].sum()
+        classified_summary[sentiment_col] = classified_summary[classified_col].map(state['score_sums']) / \
+            classified_summary['count']
+        classified_summary['推理原因'] = classified_summary[classified_col].map(state['reasons']).fillna('')
+        classified_summary = classified_summary.sort_values(classified_col).reset_index(drop=True)
         print('TextSummary starts working...')
-        self.classified_summary = await self.multi_agent_team['TextSummaryAgent'].batch_run(self.classified_df,
-                                                                                            content_col, sentiment_col,
-                                                                                            classified_col)
+        self.classified_summary = await self.multi_agent_team['TextSummaryAgent'].batch_run(
+            self.classified_df, content_col, sentiment_col, classified_col, max_concurrency=max_concurrency,
+            classified_summary=classified_summary, tfidf=state['tfidf'])
+        state['reasons'] = dict(zip(self.classified_summary[classified_col], self.classified_summary['推理原因']))
+
         print('ConclusionSummaryAgent starts working...')
         self.conclusion_summary = await self.multi_agent_team['ConclusionSummaryAgent'].batch_run(
-            self.classified_summary)
+            self.classified_summary, max_concurrency)
+        self.save_incremental_state(state_path, state)
 
         return [self.pre_classified_summary, self.classified_df, self.classified_summary, self.conclusion_summary]
+
+    def update_aggregates(self, state, classified_df, sentiment_col, classified_col):
+        labels = classified_df[classified_col].astype(object)
+        for label, count in labels.value_counts().items():
+            state['class_counts'][label] = state['class_counts'].get(label, 0) + count
+        scores = classified_df[sentiment_col].astype('float64').groupby(labels).sum()
+        for label, score_sum in scores.items():
+            state['score_sums'][label] = state['score_sums'].get(label, 0.0) + score_sum
+
+    def update_cluster_aggregates(self, state, pre_classified_df, sentiment_col):
+        for cluster, count in pre_classified_df['cluster'].value_counts().items():
+            state['cluster_counts'][cluster] = state['cluster_counts'].get(cluster, 0) + count
+        scores = pre_classified_df[sentiment_col].astype('float64').groupby(pre_classified_df['cluster']).sum()
+        for cluster, score_sum in scores.items():
+            state['cluster_score_sums'][cluster] = state['cluster_score_sums'].get(cluster, 0.0) + score_sum
+
+    def get_cumulative_pre_classified_summary(self, state, sentiment_col):
+        # 各簇的数量、占比及平均情感分按累计统计重新计算，关键词及体验问题沿用首次运行的结果
+        summary = state['pre_classified_summary'].copy()
+        counts = summary['cluster'].map(state['cluster_counts']).fillna(0).astype('int64')
+        summary['comment_cnt'] = counts
+        summary['comment_pct'] = counts / counts.sum() if counts.sum() else 0.0
+        if sentiment_col in summary.columns:
+            summary[sentiment_col] = summary['cluster'].map(state['cluster_score_sums']) / counts
+        return summary
+
+    def load_incremental_state(self, state_path):
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'rb') as file:
+            return pickle.load(file)
+
+    def save_incremental_state(self, state_path, state):
+        # 先写入临时文件再替换，避免写入中断导致状态文件损坏
+        os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+        with open(state_path + '.tmp', 'wb') as file:
+            pickle.dump(state, file)
+        os.replace(state_path + '.tmp', state_path)
+
+    def start_checkpoint(self, checkpoint, df, content_col, pre_cluster_num, elbow_method, minibatch):
+        self.checkpoint = checkpoint
+        # 上一次运行的中间结果不再有效，之后按需从断点加载或重新计算
+        for name in self.checkpoint_frames:
+            self.__dict__.pop(name, None)
+        if checkpoint is None:
+            return
+
+        run_key = hashlib.md5(pd.util.hash_pandas_object(df[content_col], index=False).to_numpy().tobytes())
+        run_key.update(repr((self.model, self.domain, self.question_type, content_col, pre_cluster_num,
+                             elbow_method, minibatch)).encode('utf-8'))
+        checkpoint.start(run_key.hexdigest())
+
+    def share_vectorizer(self, classification_triage):
+        # 本地分类器未指定特征时，复用本次预分类阶段拟合的TF-IDF
+        if classification_triage is not None and not classification_triage.fitted and \
+                classification_triage.vectorizer is None:
+            classification_triage.vectorizer = getattr(self.multi_agent_team['TextPreClassificationAgent'], 'tfidf',
+                                                       None)
+
+    def stage_done(self, name):
+        return self.checkpoint is not None and self.checkpoint.has_frame(name)
+
+    def save_frames(self, **frames):
+        for name, frame in frames.items():
+            setattr(self, name, frame)
+            if self.checkpoint is not None:
+                self.checkpoint.save_frame(name, frame)
+
+    def __getattr__(self, name):
+        # 断点恢复时，已完成阶段的中间结果只在被访问时才从断点中加载
+        checkpoint = self.__dict__.get('checkpoint')
+        if name in self.checkpoint_frames and checkpoint is not None and checkpoint.has_frame(name):
+            frame = checkpoint.load_frame(name)
+            setattr(self, name, frame)
+            return frame
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    @timed_stage('stream_run')
+    async def stream_run(self, df, batch_size=30, content_col='content', sentiment_col='score', pre_cluster_num=20,
+                         classified_col='class', max_concurrency=1, token_budget=None, adaptive_batch=False,
+                         n_jobs=1, tokenize_cache=None, elbow_method='full', minibatch=False, stream_min_rows=1000,
+                         dedup=None, dedup_report=True, triage=None,
+                        classification_triage=None):
+        n_jobs = resolve_n_jobs(n_jobs)
+        if self.aspect_teams:
+            raise ValueError("stream_run does not support a list of question types, use batch_run instead")
+        # 流式模式不支持断点，清除上一次运行留下的断点及中间结果
+        self.start_checkpoint(None, df, content_col, pre_cluster_num, elbow_method, minibatch)
+        self.sentiment_df = df.copy()
+        self.sentiment_df[sentiment_col] = ''
+        contents = self.sentiment_df[content_col].to_numpy()
+        scores = np.full(len(self.sentiment_df), '', dtype=object)
+        tokenize_cache = {} if tokenize_cache is None else tokenize_cache
+        classification_agent = self.multi_agent_team['TextClassificationAgent']
+        pre_classification_agent = self.multi_agent_team['TextPreClassificationAgent']
+        # 同一个TextClassificationAgent的batch_run复用其agent，各批负向文本的分类需依次进行
+        classify_lock = asyncio.Lock()
+
+        def get_negative_df(positions):
+            negative_df = self.sentiment_df.iloc[positions].copy()
+            # 与batch_run的输出一致，情感分以可空的Int8存储
+            negative_df[sentiment_col] = pd.array(pd.to_numeric(scores[positions], errors='coerce'), dtype='Int8')
+            return negative_df.reset_index()
+
+        async def label_sample(positions):
+            # 负向文本累计到stream_min_rows条后，先基于这部分文本预分类并确定问题标签
+            print('TextPreClassificationAgent starts working on the first {} negative rows...'.format(len(positions)))
+            pre_classified_summary = await pre_classification_agent.batch_run(
+                negative_sentiment_df=get_negative_df(positions), content_col=content_col,
+                pre_cluster_num=pre_cluster_num, n_jobs=n_jobs, tokenize_cache=tokenize_cache,
+                elbow_method=elbow_method, minibatch=minibatch, max_concurrency=max_concurrency)
+            print('TextClassificationAgent starts working...')
+            await classification_agent.summary2label(pre_classified_summary)
+            pre_classified_df = pre_classification_agent.pre_classified_df
+            pre_classified_df[classified_col] = ''
+            self.share_vectorizer(classification_triage)
+            async with classify_lock:
+                return await classification_agent.batch_run(pre_classified_df, batch_size=batch_size,
+                                                            content_col=content_col, classified_col=classified_col,
+                                                            max_concurrency=max_concurrency,
+                                                            token_budget=token_budget,
+                                                            adaptive_batch=adaptive_batch, dedup=dedup,
+                                                            dedup_report=dedup_report, n_jobs=n_jobs,
+                                                            tokenize_cache=tokenize_cache,
+                                                            triage=classification_triage)
+
+        async def classify_rows(positions):
+            # 之后到达的负向文本沿用已拟合的聚类模型分配簇，并按已确定的标签分类
+            pre_classified_df = await asyncio.to_thread(pre_classified_predict, get_negative_df(positions),
+                                                        content_col, pre_classification_agent.tfidf,
+                                                        pre_classification_agent.kmeans, n_jobs, tokenize_cache)
+            pre_classified_df[classified_col] = ''
+            async with classify_lock:
+                return await classification_agent.batch_run(pre_classified_df, batch_size=batch_size,
+                                                            content_col=content_col, classified_col=classified_col,
+                                                            max_concurrency=max_concurrency,
+                                                            token_budget=token_budget,
+                                                            adaptive_batch=adaptive_batch, dedup=dedup,
+                                                            dedup_report=dedup_report, n_jobs=n_jobs,
+                                                            tokenize_cache=tokenize_cache,
+                                                            triage=classification_triage)
+
+        print('SentimentAnalysisAgent starts working in streaming mode...')
+        score_queue = asyncio.Queue()
+        sentiment_task = asyncio.create_task(self.multi_agent_team['SentimentAnalysisAgent'].batch_run(
+            sentiment_df=self.sentiment_df, batch_size=batch_size, content_col=content_col,
+            sentiment_col=sentiment_col, max_concurrency=max_concurrency, token_budget=token_budget,
+            adaptive_batch=adaptive_batch, result_queue=score_queue, dedup=dedup, dedup_report=dedup_report,
+            n_jobs=n_jobs, tokenize_cache=tokenize_cache, triage=triage))
+
+        negative_positions = []
+        pending_positions = []
+        label_task = None
+        classify_positions = []
+        classify_tasks = []
+        while True:
+            item = await score_queue.get()
+            if item is None:
+                break
+            positions, batch_scores = item
+            scores[positions] = batch_scores
+            positions = positions[batch_scores.astype('float64') <= 3]
+            if not len(positions):
+                continue
+
+            # 负向文本到达后即在线程中分词并写入分词缓存，之后的聚类与簇分配直接复用
+            await asyncio.to_thread(chinese_preprocess_batch, contents[positions], n_jobs,
+                                    tokenize_cache=tokenize_cache)
+            negative_positions.append(positions)
+            if label_task is None:
+                if stream_min_rows is not None and sum(map(len, negative_positions)) >= stream_min_rows:
+                    classify_positions.append(np.sort(np.concatenate(negative_positions)))
+                    label_task = asyncio.create_task(label_sample(classify_positions[0]))
+                continue
+
+            pending_positions.append(positions)
+            if label_task.done() and sum(map(len, pending_positions)) >= batch_size * max_concurrency:
+                classify_positions.append(np.concatenate(pending_positions))
+                classify_tasks.append(asyncio.create_task(classify_rows(classify_positions[-1])))
+                pending_positions = []
+
+        self.sentiment_df = await sentiment_task
+        self.negative_sentiment_df = self.sentiment_df[
+            self.sentiment_df[sentiment_col].astype('float64') <= 3].reset_index().copy()
+
+        if label_task is None:
+            # 负向文本不足stream_min_rows条时，按完整数据依次执行后续阶段，分词结果已在缓存中
+            return await self.classify_and_summarize(batch_size, content_col, sentiment_col, pre_cluster_num,
+                                                     classified_col, max_concurrency, token_budget, adaptive_batch,
+                                                     n_jobs, tokenize_cache, elbow_method, minibatch, dedup,
+                                                     dedup_report, classification_triage)
+
+        classified_dfs = [await label_task]
+        if pending_positions:
+            classify_positions.append(np.concatenate(pending_positions))
+            classify_tasks.append(asyncio.create_task(classify_rows(classify_positions[-1])))
+        classified_dfs += await asyncio.gather(*classify_tasks)
+
+        # 各批结果按原始行位置排序后合并，与非流式模式的负向文本顺序一致
+        order = np.argsort(np.concatenate(classify_positions), kind='stable')
+        self.classified_df = pd.concat(classified_dfs, ignore_index=True).iloc[order].reset_index(drop=True)
+        self.pre_classified_df = self.classified_df.drop(columns=classified_col)
+        # 聚类时的预分类汇总只统计了前stream_min_rows条负向文本，按合并后的全部负向文本重新统计各簇数量、占比及平均情感分
+        cluster_state = {'pre_classified_summary': pre_classification_agent.pre_classified_summary,
+                         'cluster_counts': {}, 'cluster_score_sums': {}}
+        self.update_cluster_aggregates(cluster_state, self.pre_classified_df, sentiment_col)
+        self.pre_classified_summary = self.get_cumulative_pre_classified_summary(cluster_state, sentiment_col)
+
+        return await self.summarize(content_col, sentiment_col, classified_col, max_concurrency)
+
+    def retry_stats(self):
+        stats = {name: dict(agent.retry_stats) for name, agent in self.multi_agent_team.items() if
+                 hasattr(agent, 'retry_stats')}
+        for aspect, aspect_team in self.aspect_teams.items():
+            stats.update({'{}[{}]'.format(name, aspect): agent_stats for name, agent_stats in
+                          aspect_team.retry_stats().items() if name != 'SentimentAnalysisAgent'})
+        return stats
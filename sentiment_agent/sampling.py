@@ -0,0 +1,35 @@
+import numpy as np
+
+from .batching import estimate_tokens, truncate_text
+from .dedup import normalize_text
+
+
+def get_representative_texts(texts, X, centroid=None, token_budget=3000, max_texts=None, max_text_tokens=200):
+    from sklearn.utils.extmath import row_norms
+
+    # 按TF-IDF向量与簇中心的距离由近到远选取文本，去除重复文本并截断过长文本，直至达到token预算；token_budget为None时不限制
+    if centroid is None:
+        centroid = np.asarray(X.mean(axis=0)).ravel()
+    # 与中心的平方距离去掉对排序无影响的常数项||c||^2
+    distances = row_norms(X, squared=True) - 2 * np.asarray(X @ centroid).ravel()
+    order = np.argsort(distances, kind='stable')
+
+    selected = []
+    seen = set()
+    used_tokens = 0
+    for i in order:
+        key = normalize_text(texts[i])
+        if key in seen:
+            continue
+        text = truncate_text(texts[i], max_text_tokens)
+        # 每条文本额外计入1个换行符
+        text_tokens = estimate_tokens(text) + 1
+        if selected and token_budget is not None and used_tokens + text_tokens > token_budget:
+            break
+        seen.add(key)
+        selected.append(text)
+        used_tokens += text_tokens
+        if max_texts is not None and len(selected) >= max_texts:
+            break
+
+    return selected
@@ -1,108 +1,133 @@
 import re
+from collections import Counter
 
 import numpy as np
+import pandas as pd
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
-from tqdm.asyncio import tqdm_asyncio
 
+from .batching import BatchAnalysisMixin, estimate_tokens
+from .metrics import Metrics, timed_stage
+from .model_client import get_model_client, get_model_context
 
-class SentimentAnalysisAgent:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+
+class SentimentAnalysisAgent(BatchAnalysisMixin):
+    # 多次重试及拆分后仍无法解析的文本使用该情感分，转换为float64后为NaN，不会被归入负向文本
+    failed_score = 'nan'
+    count_prompt = '''输出结果数量为{output_num}，与输入文本内容数量{input_num}不一致，请检查确保分割符划分正确。
+                                    每条文本内容之间的分隔符为<sep>，
+                                    请重新输出情感分，确保输出结果数量等于给定文本内容数量。'''
+
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, model_client=None, max_attempts=3, metrics=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
-        self.model_client = OpenAIChatCompletionClient(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            model=self.model,
-            temperature=0,
-            model_info={
-                "vision": True,
-                "function_calling": True,
-                "json_output": False,
-                "family": ModelFamily.R1,
-                "structured_output": True,
-            },
-        )
-        self.sentiment_analysis_agent = AssistantAgent(
-            name="sentiment_analysis_agent",
-            model_client=self.model_client,
-            system_message="""你是一个{domain}领域的情感分析的专家，给定多条文本内容，每条文本内容之间以符号<sep>作为分割符，请对每条文本内容分别判断用户在{domain}领域对{question_type}问题的情感倾向，输出结果为情感分，取值范围为[0,10]，其中[0,3]为负向、(3,6]为中性、(6,10]为正向。
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.max_attempts = max_attempts
+        self.retry_stats = Counter()
+        self.metrics = metrics or Metrics()
+        # question_type为列表时进入多问题类型模式，一次调用对每条文本按列表顺序分别给出各问题类型的情感分
+        self.multi_aspect = not isinstance(question_type, str)
+        self.num_aspects = len(question_type) if self.multi_aspect else 1
+        # 传入model_client时与其他agent共享同一个客户端（连接池、限流与缓存）
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store)
+        self.system_message = """你是一个{domain}领域的情感分析的专家，给定多条文本内容，每条文本内容之间以符号<sep>作为分割符，请对每条文本内容分别判断用户在{domain}领域对{question_type}问题的情感倾向，输出结果为情感分，取值范围为[0,10]，其中[0,3]为负向、(3,6]为中性、(6,10]为正向。
                                                                     回答模板格式如下：xx<sep>xx<sep>xx<sep>...<sep>xx
-                                                                    其中xx表示取值范围为[0,10]的情感分，<sep>为分隔符。""".format(domain=self.domain, question_type=self.question_type), )
+                                                                    其中xx表示取值范围为[0,10]的情感分，<sep>为分隔符。""".format(domain=self.domain, question_type=self.question_type)
+        self.answer_template = 'xx<sep>xx<sep>xx<sep>...<sep>xx'
+        if self.multi_aspect:
+            aspect_answer = '<sep0>'.join(['xx'] * self.num_aspects)
+            self.answer_template = '<sep>'.join([aspect_answer, aspect_answer, '...', aspect_answer])
+            self.system_message = """你是一个{domain}领域的情感分析的专家，给定多条文本内容，每条文本内容之间以符号<sep>作为分割符，请对每条文本内容分别判断用户在{domain}领域对以下{num}个问题的情感倾向：{question_types}。每个问题输出一个情感分，取值范围为[0,10]，其中[0,3]为负向、(3,6]为中性、(6,10]为正向，文本未涉及的问题按中性打分。
+                                                                    回答模板格式如下：{template}
+                                                                    其中xx表示取值范围为[0,10]的情感分，每条文本的{num}个情感分按上述问题顺序以<sep0>分隔，各条文本之间以<sep>分隔。""".format(
+                domain=self.domain, num=self.num_aspects, template=self.answer_template,
+                question_types='、'.join('{}.{}'.format(i + 1, question_type) for i, question_type in
+                                        enumerate(self.question_type)))
+        self.format_prompt = '''输出结果数据类型与给定回答模板格式不一致，请检查确保数据类型正确，
+                                    回答模板格式如下：{}
+                                    其中xx表示取值范围为[0,10]的情感分。
+                                    请重新输出情感分，确保输出数据类型与模板格式一致。'''.format(self.answer_template)
+        self.failed_answer = ','.join([self.failed_score] * self.num_aspects)
+        self.sentiment_analysis_agent = self.get_sentiment_analysis_agent()
 
+    def get_sentiment_analysis_agent(self):
+        return AssistantAgent(
+            name="sentiment_analysis_agent",
+            model_client=self.model_client,
+            model_context=get_model_context(self.buffer_size),
+            system_message=self.system_message, )
+
+    def record_retry(self, retry_type, retry_stats=None):
+        self.retry_stats[retry_type] += 1
+        self.metrics.record_retry(self.sentiment_analysis_agent.name, retry_type)
+        if retry_stats is not None:
+            retry_stats[retry_type] += 1
+
+    def get_score_columns(self, sentiment_col):
+        # 多问题类型模式下每个问题类型的情感分单独一列
+        if not self.multi_aspect:
+            return [sentiment_col]
+        return ['{}_{}'.format(sentiment_col, question_type) for question_type in self.question_type]
+
+    def parse_answer(self, answer):
+        # 返回规范化后的情感分，多问题类型模式下各问题类型的情感分以逗号连接；格式错误时返回None
+        parts = [part.strip() for part in answer.split('<sep0>')] if self.multi_aspect else [answer.strip()]
+        if len(parts) != self.num_aspects or not all(re.fullmatch(r'[0-9]|10', part) for part in parts):
+            return None
+        return ','.join(parts)
+
+    @timed_stage('sentiment')
     async def batch_run(self, sentiment_df, batch_size=30, content_col: str = 'content',
-                        sentiment_col: str = 'score'):
+                        sentiment_col: str = 'score', max_concurrency: int = 1, token_budget=None,
+                        adaptive_batch=False, result_queue=None, checkpoint=None, dedup=None, dedup_report=True,
+                        n_jobs=1, tokenize_cache=None, triage=None):
+        if triage is not None and self.multi_aspect:
+            raise ValueError("triage is not supported when question_type is a list")
+
+        # 各batch仅读取所需的文本切片并返回情感分，结果统一写入预分配的数组，避免逐batch复制整个DataFrame
+        contents = sentiment_df[content_col].to_numpy()
+        scores = sentiment_df[sentiment_col].to_numpy(dtype=object, copy=True)
+
+        def push_result(positions):
+            # 流式模式下每完成一个batch即推送(行位置, 情感分)，供下游阶段提前处理
+            result_queue.put_nowait((positions, scores[positions]))
+
+        try:
+            duplicate_groups = await self.dispatch_batches(
+                contents, scores, self.sentiment_analysis_agent, self.get_sentiment_analysis_agent, 'sentiment',
+                'sentiment analysis', '情感分析', batch_size=batch_size, max_concurrency=max_concurrency,
+                token_budget=token_budget, prompt_tokens=estimate_tokens(self.system_message),
+                output_tokens=4 * self.num_aspects, adaptive_batch=adaptive_batch, checkpoint=checkpoint, dedup=dedup,
+                dedup_report=dedup_report, n_jobs=n_jobs, tokenize_cache=tokenize_cache, triage=triage,
+                on_complete=push_result if result_queue is not None else None)
+        finally:
+            if result_queue is not None:
+                # None表示情感分析结束，异常退出时同样推送，避免下游一直等待
+                result_queue.put_nowait(None)
+        if duplicate_groups is not None:
+            self.dedup_ratio = duplicate_groups.dedup_ratio
 
-        self.sentiment_df = sentiment_df.copy()
-        start_tag = self.sentiment_df[self.sentiment_df[sentiment_col] == ''].index.min()
-        end_tag = self.sentiment_df[self.sentiment_df[sentiment_col] == ''].index.max() + 1
-
-        if not np.isnan(start_tag):
-            index_list = list(range(start_tag, end_tag, batch_size))
-            index_list.append(end_tag)
-
-        pbar = tqdm_asyncio(total=len(self.sentiment_df[self.sentiment_df[sentiment_col] == '']),
-                            desc="sentiment analysis complete progress")
-        for i in range(len(index_list) - 1):
-            start_index = index_list[i]
-            end_index = index_list[i + 1]
-            self.sentiment_df = await self.run(self.sentiment_df, start_index, end_index, content_col,
-                                               sentiment_col)
-            pbar.update(end_index - start_index)
-
-        pbar.close()
         print("sentiment analysis completion completed")
 
-        return self.sentiment_df
-
-    async def run(self, sentiment_df, start_index, end_index, content_col: str = 'content',
-                  sentiment_col: str = 'score'):
         self.sentiment_df = sentiment_df.copy()
-        error_answer = True
-        num_prompt = ''
-        dtype_prompt = ''
-
-        task_message = "<sep>".join(self.sentiment_df[content_col].iloc[start_index: end_index])
-        while error_answer:
-
-            result = await self.sentiment_analysis_agent.run(task='\n\n'.join([num_prompt, dtype_prompt, task_message]))
+        if self.multi_aspect:
+            scores = np.array([score.split(',') for score in scores], dtype=object).reshape(len(scores),
+                                                                                            self.num_aspects)
+            self.sentiment_df = self.sentiment_df.drop(columns=sentiment_col)
+        else:
+            scores = scores.reshape(-1, 1)
+        # 情感分取值为0-10，以可空的Int8存储，分析失败的文本为缺失值
+        for j, score_col in enumerate(self.get_score_columns(sentiment_col)):
+            self.sentiment_df[score_col] = pd.array(pd.to_numeric(scores[:, j], errors='coerce'), dtype='Int8')
 
-            response = result.messages[-1].content
-
-            input_num = end_index - start_index
-            output_num = len(response.strip().strip('<sep>').split('<sep>'))
-            if output_num != input_num:
-                num_prompt = '''输出结果数量为{}，与输入文本内容数量{}不一致，请检查确保分割符划分正确。
-                                    每条文本内容之间的分隔符为<sep>，
-                                    请重新输出情感分，确保输出结果数量等于给定文本内容数量。'''.format(output_num,
-                                                                                                     input_num)
-                print(
-                    "第{}-{}行的分析存在输出数量{}与输入数量{}不一致错误，将重新进行分析，若多次失败，建议减少batch_size的值以提升模型性能。".format(
-                        start_index, end_index, output_num, input_num))
-                print(response)
-                continue
-
-
-            elif not bool(re.fullmatch(r'^([0-9]<sep>|10<sep>){' + r'{}'.format(input_num - 1) + r'}([0-9]|10)$',
-                                       response.strip().strip('<sep>'))):
-                dtype_prompt = '''输出结果数据类型与给定回答模板格式不一致，请检查确保数据类型正确，
-                                    回答模板格式如下：xx<sep>xx<sep>xx<sep>...<sep>xx
-                                    其中xx表示取值范围为[0,10]的情感分。
-                                    请重新输出情感分，确保输出数据类型与模板格式一致。'''
-                print(
-                    "第{}-{}行的分析存在数据格式错误，将重新进行分析，若多次失败，建议减少batch_size的值以提升模型性能。".format(
-                        start_index, end_index))
-                print(response)
-                continue
-
-            else:
-                error_answer = False
-
-        self.sentiment_df.loc[start_index: end_index - 1, sentiment_col] = response.strip().strip('<sep>').split(
-            '<sep>')
+        return self.sentiment_df
 
-        return self.sentiment_df
\ No newline at end of file
+    async def run(self, texts, start_index, end_index, agent=None, retry_stats=None):
+        return await self.run_batch(texts, start_index, end_index, agent or self.sentiment_analysis_agent,
+                                    retry_stats)
@@ -1,35 +1,130 @@
+import asyncio
+import builtins
+import concurrent.futures
+import os
 import re
+import select
+import sys
+import threading
+from collections import Counter
+from contextlib import nullcontext
 
 import numpy as np
+import pandas as pd
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
-from tqdm.asyncio import tqdm_asyncio
+from autogen_core import CancellationToken
 
+from .batching import BatchAnalysisMixin, estimate_tokens
+from .metrics import Metrics, timed_stage
+from .model_client import get_model_client, get_model_context
+from .utils import chinese_preprocess_batch
 
-class TextClassificationAgent:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+
+# 正在等待输入的读取结果，超时后读取线程仍在等待，下一次审批复用该结果，避免多个线程同时读取标准输入
+pending_input = None
+
+
+def is_piped_stdin():
+    # 标准输入为管道或文件时input()阻塞期间持有缓冲区锁，读取线程停在input()中时解释器退出会中止进程；
+    # 终端及Jupyter等替换了input()的环境不受影响
+    if os.name != 'posix' or sys.stdin is None or sys.stdin.isatty():
+        return False
+    return getattr(builtins.input, '__module__', None) == 'builtins'
+
+
+def read_stdin(prompt, future):
+    try:
+        if is_piped_stdin():
+            # 先用select等待可读，等待期间不持有缓冲区锁
+            print(prompt, end='', flush=True)
+            select.select([sys.stdin], [], [])
+            prompt = ''
+        future.set_result(input(prompt))
+    except Exception as error:
+        future.set_exception(error)
+
+
+def read_input(prompt):
+    # input()无法取消，在守护线程中读取并通过Future返回，超时后不会阻塞事件循环关闭及解释器退出
+    global pending_input
+    if pending_input is None or pending_input.done():
+        pending_input = concurrent.futures.Future()
+        threading.Thread(target=read_stdin, args=(prompt, pending_input), daemon=True).start()
+    else:
+        print(prompt, end='', flush=True)
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_future(source):
+        if future.done():
+            return
+        if source.exception() is not None:
+            future.set_exception(source.exception())
+        else:
+            future.set_result(source.result())
+
+    def on_input(source):
+        try:
+            loop.call_soon_threadsafe(set_future, source)
+        except RuntimeError:
+            # 事件循环已关闭，说明已超时并采用了大模型总结的标签
+            pass
+
+    pending_input.add_done_callback(on_input)
+    return future
+
+
+class TextClassificationAgent(BatchAnalysisMixin):
+    # 标签集合中始终包含该标签，用于未被其他标签覆盖的问题
+    other_label = '其他问题'
+    # 多次重试及拆分后仍无法给出有效标签的文本标记为该值，分类结果中为缺失值，不计入问题标签汇总
+    failed_label = None
+    failed_answer = failed_label
+    format_error = 'invalid_label'
+    count_prompt = '''输出结果数量与给定文本内容数量不一致，请检查确保分割符划分正确。
+                    每条文本内容之间的分隔符为<sep>，输出结果的分隔符为<sep>，
+                    请重新输出体验问题标签，确保输出结果数量与给定文本内容数量一致。'''
+    format_prompt = '''输出结果标签不属于给定标签集合，请检查确保标签属于给定标签集合。
+                        每条文本内容之间的分隔符为<sep>，输出结果的分隔符为<sep>，
+                        请重新输出体验问题标签，确保标签属于给定的标签集合。'''
+    # 文件审批模式下检查反馈文件的时间间隔（秒）
+    approval_poll_interval = 5
+
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, model_client=None, max_attempts=3, approval='input', approval_callback=None,
+                 approval_file=None, approval_timeout=None, class_labels=None, metrics=None, approval_lock=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
-        self.model_client = OpenAIChatCompletionClient(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            model=self.model,
-            temperature=0,
-            model_info={
-                "vision": True,
-                "function_calling": True,
-                "json_output": False,
-                "family": ModelFamily.R1,
-                "structured_output": True,
-            },
-        )
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.max_attempts = max_attempts
+        if approval not in ('input', 'auto', 'callback', 'file'):
+            raise ValueError("approval must be 'input', 'auto', 'callback' or 'file', got {!r}".format(approval))
+        if approval == 'callback' and approval_callback is None:
+            raise ValueError("approval_callback is required when approval='callback'")
+        if approval == 'file' and approval_file is None:
+            raise ValueError("approval_file is required when approval='file'")
+        # 标签审批方式：input为交互式输入，auto为直接采用大模型总结的标签，callback为异步回调，file为读取反馈文件
+        self.approval = approval
+        self.approval_callback = approval_callback
+        self.approval_file = approval_file
+        self.approval_timeout = approval_timeout
+        # 多个问题类型的标签并发总结时共用同一个锁，人工审批依次进行
+        self.approval_lock = approval_lock or nullcontext()
+        self.preset_labels = class_labels
+        self.retry_stats = Counter()
+        self.metrics = metrics or Metrics()
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store)
         self.summary2label_agent = AssistantAgent(
             name="summary2label_agent",
             model_client=self.model_client,
+            model_context=get_model_context(self.buffer_size),
 
             system_message="""你是一个{question_type}问题总结的专家，给定文本内容，请推理用户在{domain}领域可能存在哪些{question_type}问题，请将相似问题进行合并分类，避免重复回答，输出结果为{question_type}问题，请分条列点并用简要词汇概括。
                                                             回答模板格式如下：{question_type}问题：1.xx<sep>2.xx<sep>3.xx<sep>...<sep>N.xx
@@ -37,9 +132,18 @@ class TextClassificationAgent:
                 domain=self.domain, question_type=self.question_type),
         )
 
+    @timed_stage('labels')
     async def summary2label(self, pre_classified_summary):
 
         self.pre_classified_summary = pre_classified_summary.copy()
+        if self.preset_labels is not None:
+            print('使用预先提供的问题标签，跳过问题标签总结')
+            self.set_class_labels(list(dict.fromkeys(list(self.preset_labels) + [self.other_label])))
+            return
+
+        # 人工反馈的多轮修改需要保留在上下文中，因此只在每次总结标签开始时重置
+        if self.stateless:
+            await self.summary2label_agent.on_reset(CancellationToken())
         error_answer = True
         human_prompt = ''
 
@@ -50,18 +154,17 @@ class TextClassificationAgent:
                     + "推理原因为："
                     + self.pre_classified_summary["推理原因"]
             ))
-            result = await self.summary2label_agent.run(task='\n\n'.join([human_prompt, task_message]))
+            result = await self.metrics.run_agent(self.summary2label_agent, task='\n\n'.join([human_prompt, task_message]))
 
             response = result.messages[-1].content
             print('Chain of thought:', result.messages[1].content)
             print(f'{self.question_type}问题:', ','.join(response.split('<sep>')))
-            human_feedback = input(
-                '''请对大模型总结的问题标签提供反馈，\n如果赞同请回复[y]。\n如果不赞同并需要大模型重新总结请回复[n]并提供提示词，请以如下格式回复：\nn<sep>xxxx\n其中xxxx表示提示词，<sep>为分隔符。\n如果您只需要修改大模型总结的部分结论，请以如下格式回复：\n1.xx<sep>2.xx<sep>3.xx<sep>...<sep>N.xx\n其中xx表示{question_type}问题，<sep>为分隔符。\n请输入你的反馈：'''.format(
-                    question_type=self.question_type))
+            async with self.approval_lock:
+                human_feedback = await self.get_human_feedback(response, result.messages[1].content)
             if human_feedback == 'y':
                 self.class_labels = re.findall(r'\d{1,}.(\w+)',
                                                ','.join(response.strip().strip('<sep>').split('<sep>')), re.S) + [
-                                        '其他问题']
+                                        self.other_label]
                 error_answer = False
 
 
@@ -73,90 +176,126 @@ class TextClassificationAgent:
                                    ','.join(human_feedback.strip().strip('<sep>').split('<sep>')))):
                 custom_labels = re.findall(r'\d{1,}.(\w+)',
                                            ','.join(human_feedback.strip().strip('<sep>').split('<sep>')), re.S)
-                self.class_labels = custom_labels + ['其他问题']
+                self.class_labels = custom_labels + [self.other_label]
                 error_answer = False
 
             else:
                 print('回答内容无效，将重新进行问题总结。')
 
-        self.text_classification_agent = AssistantAgent(
-            name="text_classified_agent",
-            model_client=self.model_client,
-            system_message="""你是一个{question_type}问题分类的专家，给定多条文本内容，每条文本内容之间以符号<sep>作为分割符，已知{question_type}问题标签集合为{class_labels}，请对每条文本内容分别判断所属的问题标签，输出结果为问题标签，且每条文本内容只能属于集合中的一个标签。
+        self.set_class_labels(self.class_labels)
+
+    async def get_human_feedback(self, response, chain_of_thought):
+        if self.approval == 'auto':
+            return 'y'
+
+        if self.approval == 'input':
+            # 在守护线程中等待输入，等待期间事件循环中的其他任务可继续运行
+            feedback = read_input(
+                '''请对大模型总结的问题标签提供反馈，\n如果赞同请回复[y]。\n如果不赞同并需要大模型重新总结请回复[n]并提供提示词，请以如下格式回复：\nn<sep>xxxx\n其中xxxx表示提示词，<sep>为分隔符。\n如果您只需要修改大模型总结的部分结论，请以如下格式回复：\n1.xx<sep>2.xx<sep>3.xx<sep>...<sep>N.xx\n其中xx表示{question_type}问题，<sep>为分隔符。\n请输入你的反馈：'''.format(
+                    question_type=self.question_type))
+        elif self.approval == 'callback':
+            # 回调接收大模型总结的标签及思维链，返回与交互式输入格式相同的反馈
+            feedback = self.approval_callback(','.join(response.split('<sep>')), chain_of_thought)
+        else:
+            feedback = self.wait_approval_file(response)
+
+        if self.approval_timeout is None:
+            return await feedback
+        try:
+            return await asyncio.wait_for(feedback, self.approval_timeout)
+        except asyncio.TimeoutError:
+            # 超时未收到反馈时直接采用大模型总结的标签，避免无人值守的任务一直等待
+            print('等待问题标签反馈超时，将直接采用大模型总结的问题标签。')
+            return 'y'
+
+    async def wait_approval_file(self, response):
+        # 将待审批的标签写入approval_file.proposal，轮询approval_file获取反馈，反馈格式与交互式输入相同
+        if os.path.exists(self.approval_file):
+            os.remove(self.approval_file)
+        with open(self.approval_file + '.proposal', 'w', encoding='utf-8') as file:
+            file.write(','.join(response.split('<sep>')))
+        print('问题标签已写入{}，请将反馈写入{}'.format(self.approval_file + '.proposal', self.approval_file))
+
+        while not os.path.exists(self.approval_file):
+            await asyncio.sleep(self.approval_poll_interval)
+        with open(self.approval_file, 'r', encoding='utf-8') as file:
+            feedback = file.read().strip()
+        os.remove(self.approval_file)
+
+        return feedback
+
+    def set_class_labels(self, class_labels):
+        self.class_labels = class_labels
+        # 标签集合按固定顺序写入提示词，保证相同输入的提示词在多次运行间一致，可命中响应缓存
+        self.text_classification_system_message = """你是一个{question_type}问题分类的专家，给定多条文本内容，每条文本内容之间以符号<sep>作为分割符，已知{question_type}问题标签集合为{class_labels}，请对每条文本内容分别判断所属的问题标签，输出结果为问题标签，且每条文本内容只能属于集合中的一个标签。
                                 回答模板格式如下：xx<sep>xx<sep>xx<sep>...<sep>xx
                                 其中xx表示体验问题标签，<sep>为分隔符。""".format(question_type=self.question_type,
-                                                                                class_labels=set(self.class_labels)),
+                                                                                class_labels='{' + ', '.join(
+                                                                                    map(repr, dict.fromkeys(
+                                                                                        self.class_labels))) + '}')
+        self.text_classification_agent = self.get_text_classification_agent()
+
+    def get_text_classification_agent(self):
+        return AssistantAgent(
+            name="text_classified_agent",
+            model_client=self.model_client,
+            model_context=get_model_context(self.buffer_size),
+            system_message=self.text_classification_system_message,
         )
 
+    def record_retry(self, retry_type, retry_stats=None):
+        self.retry_stats[retry_type] += 1
+        self.metrics.record_retry(self.text_classification_agent.name, retry_type)
+        if retry_stats is not None:
+            retry_stats[retry_type] += 1
+
+    @timed_stage('classification')
     async def batch_run(self, pre_classified_df, batch_size=30, content_col: str = 'content',
-                        classified_col: str = 'class'):
+                        classified_col: str = 'class', max_concurrency: int = 1, token_budget=None,
+                        adaptive_batch=False, checkpoint=None, dedup=None, dedup_report=True,
+                        n_jobs=1, tokenize_cache=None, triage=None):
 
-        self.classified_df = pre_classified_df.copy()
-        start_tag = self.classified_df[self.classified_df[classified_col] == ''].index.min()
-        end_tag = self.classified_df[self.classified_df[classified_col] == ''].index.max() + 1
-
-        if not np.isnan(start_tag):
-            index_list = list(range(start_tag, end_tag, batch_size))
-            index_list.append(end_tag)
-
-        pbar = tqdm_asyncio(total=len(self.classified_df[self.classified_df[classified_col] == '']),
-                            desc="text classification complete progress")
-        for i in range(len(index_list) - 1):
-            start_index = index_list[i]
-            end_index = index_list[i + 1]
-            await self.run(self.classified_df, start_index, end_index, content_col,
-                           classified_col)
-            pbar.update(end_index - start_index)
-
-        pbar.close()
-        print("text classification completion completed")
+        # 各batch仅读取所需的文本切片并返回问题标签，结果统一写入预分配的数组，避免逐batch复制整个DataFrame
+        contents = pre_classified_df[content_col].to_numpy()
+        labels = pre_classified_df[classified_col].to_numpy(dtype=object, copy=True)
 
-        return self.classified_df
+        def get_corpus(pending_positions):
+            # 本地分类器使用与预分类一致的分词结果作为特征
+            if 'corpus' in pre_classified_df.columns:
+                return pre_classified_df['corpus'].to_numpy()
+            corpus = np.empty(len(contents), dtype=object)
+            corpus[pending_positions] = chinese_preprocess_batch(contents[pending_positions], n_jobs=n_jobs,
+                                                                 tokenize_cache=tokenize_cache)
+            return corpus
 
-    async def run(self, classified_df, start_index, end_index, content_col,
-                  classified_col):
-        self.classified_df = classified_df.copy()
-        error_answer = True
-        num_prompt = ''
-        label_prompt = ''
+        duplicate_groups = await self.dispatch_batches(
+            contents, labels, self.text_classification_agent, self.get_text_classification_agent, 'classification',
+            'text classification', '文本分类', batch_size=batch_size, max_concurrency=max_concurrency,
+            token_budget=token_budget, prompt_tokens=estimate_tokens(self.text_classification_system_message),
+            output_tokens=2 + max(estimate_tokens(label) for label in self.class_labels),
+            adaptive_batch=adaptive_batch, checkpoint=checkpoint, dedup=dedup, dedup_report=dedup_report,
+            n_jobs=n_jobs, tokenize_cache=tokenize_cache, triage=triage, get_features=get_corpus)
+        if duplicate_groups is not None:
+            self.dedup_ratio = duplicate_groups.dedup_ratio
 
-        while error_answer:
+        print("text classification completion completed")
 
-            task_message = "<sep>".join(self.classified_df[content_col].iloc[start_index: end_index])
+        num_failed = sum(label is self.failed_label for label in labels)
+        if num_failed:
+            print("共有{}条文本多次分类失败，分类结果为缺失值，不计入问题标签汇总。".format(num_failed))
 
-            result = await self.text_classification_agent.run(
-                task='\n\n'.join([num_prompt, label_prompt, task_message]))
+        self.classified_df = pre_classified_df.copy()
+        # 标签取值有限，以分类类型存储，类别顺序与标签集合一致，分类失败的文本为缺失值
+        categories = [label for label in pd.unique(labels) if label is not self.failed_label]
+        self.classified_df[classified_col] = pd.Categorical(
+            labels, categories=list(dict.fromkeys(list(self.class_labels) + categories)))
 
-            response = result.messages[-1].content
+        return self.classified_df
 
-            if len(response.strip().strip('<sep>').split('<sep>')) != end_index - start_index:
-                num_prompt = '''输出结果数量与给定文本内容数量不一致，请检查确保分割符划分正确。
-                    每条文本内容之间的分隔符为<sep>，输出结果的分隔符为<sep>，
-                    请重新输出体验问题标签，确保输出结果数量与给定文本内容数量一致。'''
-                print("第{}-{}行分析存在输入与输出数量不一致错误，将重新进行分析".format(start_index, end_index - 1))
-                print("整体返回结果为{}".format(response))
-                continue
-
-            elif len(response.strip().strip('<sep>').split('<sep>')) == end_index - start_index:
-                error_answer_num = 0
-                for label in response.strip().strip('<sep>').split('<sep>'):
-                    if error_answer_num > 0:
-                        break
-                    else:
-                        if label not in self.class_labels:
-                            error_answer_num += 1
-                            label_prompt = '''输出结果标签不属于给定标签集合，请检查确保标签属于给定标签集合。
-                        每条文本内容之间的分隔符为<sep>，输出结果的分隔符为<sep>，
-                        请重新输出体验问题标签，确保标签属于给定的标签集合。'''
-                            print("第{}-{}行分析存在标签不属于给定的标签集合，将重新进行分析".format(start_index,
-                                                                                                    end_index - 1))
-                            print("标签为：{}，整体返回结果为{}".format(label, response))
-                            break
-                        else:
-                            pass
-                if error_answer_num == 0:
-                    error_answer = False
-
-        self.classified_df.loc[start_index: end_index - 1, classified_col] = response.strip().strip(
-            '<sep>').split(
-            '<sep>')
+    def parse_answer(self, answer):
+        label = answer.strip()
+        return label if label in self.class_labels else None
+
+    async def run(self, texts, start_index, end_index, agent=None, retry_stats=None):
+        return await self.run_batch(texts, start_index, end_index, agent or self.text_classification_agent,
+                                    retry_stats)
@@ -1,88 +1,129 @@
+import asyncio
 import re
+from collections import Counter
 
-import numpy as np
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core import CancellationToken
 from tqdm.asyncio import tqdm_asyncio
 
+from .metrics import Metrics, timed_stage
+from .model_client import get_model_client, get_model_context
+from .sampling import get_representative_texts
 from .utils import pre_classified_fit
 
 
 class TextPreClassificationAgent:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, model_client=None, metrics=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
-        self.model_client = OpenAIChatCompletionClient(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            model=self.model,
-            temperature=0,
-            model_info={
-                "vision": True,
-                "function_calling": True,
-                "json_output": False,
-                "family": ModelFamily.R1,
-                "structured_output": True,
-            },
-        )
-        self.text_pre_classification_agent = AssistantAgent(
-            name="text_pre_classified_agent",
-            model_client=self.model_client,
-            system_message="""你是一个{domain}领域{question_type}问题分析的专家，给定文本内容，请推理用户在{domain}领域可能存在哪些{question_type}问题，输出结果为{question_type}问题和推理原因，其中{question_type}问题为分条列点的简要词汇概括，推理原因为分条列点回答对应的判断依据。
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.retry_stats = Counter()
+        self.metrics = metrics or Metrics()
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store)
+        self.system_message = """你是一个{domain}领域{question_type}问题分析的专家，给定文本内容，请推理用户在{domain}领域可能存在哪些{question_type}问题，输出结果为{question_type}问题和推理原因，其中{question_type}问题为分条列点的简要词汇概括，推理原因为分条列点回答对应的判断依据。
                             回答模板格式如下：{question_type}问题：1.xx<sep0>2.xx<sep0>3.xx<sep0>...<sep0>N.xx<sep1>推理原因：1.yy<sep0>2.yy<sep0>3.yy<sep0>...<sep0>N.yy
                             其中xx表示{question_type}问题，yy表示对应的推理原因，<sep0>和<sep1>为分隔符。""".format(
-                domain=self.domain, question_type=self.question_type),
-        )
+            domain=self.domain, question_type=self.question_type)
+        self.text_pre_classification_agent = self.get_text_pre_classification_agent()
 
-    async def batch_run(self, negative_sentiment_df, content_col, pre_cluster_num=20, sentiment_col=None):
-
-        self.pre_classified_df, self.pre_classified_summary = pre_classified_fit(negative_sentiment_df, content_col,
-                                                                                 pre_cluster_num, sentiment_col)
-        start_tag = self.pre_classified_summary[self.pre_classified_summary['体验问题'] == ''].index.min()
-        end_tag = self.pre_classified_summary[self.pre_classified_summary['体验问题'] == ''].index.max() + 1
-        if not np.isnan(start_tag):
-            index_list = list(range(start_tag, end_tag))
+    def get_text_pre_classification_agent(self):
+        return AssistantAgent(
+            name="text_pre_classified_agent",
+            model_client=self.model_client,
+            model_context=get_model_context(self.buffer_size),
+            system_message=self.system_message,
+        )
 
-        pbar = tqdm_asyncio(total=len(self.pre_classified_summary[self.pre_classified_summary['体验问题'] == '']),
-                            desc="text pre classification complete progress")
-        for cluster in index_list:
-            self.pre_classified_summary = await self.run(self.pre_classified_df, self.pre_classified_summary, cluster,
-                                                         content_col)
-            pbar.update(1)
+    def record_retry(self, retry_type):
+        self.retry_stats[retry_type] += 1
+        self.metrics.record_retry(self.text_pre_classification_agent.name, retry_type)
+
+    @timed_stage('pre_classification')
+    async def batch_run(self, negative_sentiment_df, content_col, pre_cluster_num=20, sentiment_col=None, n_jobs=1,
+                        tokenize_cache=None, elbow_method='full', minibatch=False, max_concurrency=1, plot_path=None,
+                        checkpoint=None, sample_token_budget=3000, max_text_tokens=200, tfidf=None):
+
+        fit_kwargs = dict(n_jobs=n_jobs, tokenize_cache=tokenize_cache, elbow_method=elbow_method,
+                          minibatch=minibatch, plot_path=plot_path, return_models=True, metrics=self.metrics,
+                          tfidf=tfidf)
+        # 在线程中聚类，避免阻塞事件循环中其他阶段的请求
+        fit_result = await asyncio.to_thread(pre_classified_fit, negative_sentiment_df, content_col, pre_cluster_num,
+                                             sentiment_col, **fit_kwargs)
+        self.pre_classified_df, self.pre_classified_summary, self.tfidf, self.kmeans = fit_result
+        if checkpoint is not None:
+            # 聚类结果在相同输入下保持一致，可直接恢复断点中已完成分析的簇
+            done = checkpoint.load_rows('pre_classification')
+            restored = self.pre_classified_summary['cluster'].isin(list(done.keys()))
+            restored_clusters = self.pre_classified_summary.loc[restored, 'cluster']
+            self.pre_classified_summary.loc[restored, '体验问题'] = restored_clusters.map(lambda cluster: done[cluster][0])
+            self.pre_classified_summary.loc[restored, '推理原因'] = restored_clusters.map(lambda cluster: done[cluster][1])
+        pending = self.pre_classified_summary['体验问题'] == ''
+        cluster_queue = asyncio.Queue()
+        for cluster in self.pre_classified_summary.loc[pending, 'cluster']:
+            cluster_queue.put_nowait(cluster)
+
+        # 各簇的分析相互独立，可并发请求；每簇只选取最靠近簇中心的代表文本，提示词长度受token预算约束
+        contents = self.pre_classified_df[content_col].to_numpy()
+        X = self.tfidf.transform(self.pre_classified_df['corpus'])
+        cluster_positions = self.pre_classified_df.groupby('cluster').indices
+        cluster_texts = {}
+        for cluster in self.pre_classified_summary.loc[pending, 'cluster']:
+            positions = cluster_positions[cluster]
+            cluster_texts[cluster] = get_representative_texts(
+                contents[positions], X[positions], self.kmeans.cluster_centers_[cluster], sample_token_budget, 100,
+                max_text_tokens)
+            if len(cluster_texts[cluster]) < len(positions):
+                print("第{}类分析，已从{}条文本中选取最具代表性的{}条".format(cluster, len(positions),
+                                                                   len(cluster_texts[cluster])))
+        answers = {}
+
+        pbar = tqdm_asyncio(total=cluster_queue.qsize(), desc="text pre classification complete progress")
+
+        async def worker(agent):
+            while not cluster_queue.empty():
+                cluster = cluster_queue.get_nowait()
+                answers[cluster] = await self.run(cluster_texts[cluster], cluster, agent)
+                pbar.update(1)
+                if checkpoint is not None:
+                    checkpoint.save_rows('pre_classification', [cluster], [answers[cluster]])
+
+        num_workers = max(1, min(max_concurrency, cluster_queue.qsize()))
+        agents = [self.text_pre_classification_agent] + [self.get_text_pre_classification_agent() for _ in
+                                                         range(num_workers - 1)]
+        await asyncio.gather(*[worker(agent) for agent in agents])
 
         pbar.close()
         print("text pre classification completion completed")
 
-        return self.pre_classified_summary
+        clusters = self.pre_classified_summary.loc[pending, 'cluster']
+        self.pre_classified_summary.loc[pending, '体验问题'] = clusters.map(lambda cluster: answers[cluster][0])
+        self.pre_classified_summary.loc[pending, '推理原因'] = clusters.map(lambda cluster: answers[cluster][1])
 
-    async def run(self, pre_classified_df, pre_classified_summary, cluster, content_col):
+        return self.pre_classified_summary
 
-        self.pre_classified_df = pre_classified_df.copy()
-        self.pre_classified_summary = pre_classified_summary.copy()
+    async def run(self, texts, cluster, agent=None):
+        agent = agent or self.text_pre_classification_agent
+        if self.stateless:
+            await agent.on_reset(CancellationToken())
 
         error_answer = True
         omit_prompt = ''
         sep_prompt = ''
         num_prompt = ''
 
-        while error_answer:
+        task_message = "\n".join(texts)
 
-            if len(self.pre_classified_df[self.pre_classified_df['cluster'] == cluster][content_col]) > 100:
-                print("第{}类分析，文本量过大，已抽样100条".format(cluster))
-                task_message = "\n".join(
-                    self.pre_classified_df[self.pre_classified_df['cluster'] == cluster][content_col].sample(n=100,
-                                                                                                             random_state=1,
-                                                                                                             replace=False))
-            else:
-                task_message = "\n".join(
-                    self.pre_classified_df[self.pre_classified_df['cluster'] == cluster][content_col])
+        while error_answer:
 
-            result = await self.text_pre_classification_agent.run(
-                task='\n\n'.join([omit_prompt, sep_prompt, num_prompt, task_message]))
+            result = await self.metrics.run_agent(
+                agent, task='\n\n'.join([omit_prompt, sep_prompt, num_prompt, task_message]))
 
             response = result.messages[-1].content
 
@@ -91,6 +132,7 @@ class TextPreClassificationAgent:
                             回答模板格式如下：体验问题：1.xx<sep0>2.xx<sep0>3.xx<sep0>...<sep0>N.xx<sep1>推理原因：1.yy<sep0>2.yy<sep0>3.yy<sep0>...<sep0>N.yy
                             其中xx表示简要词汇概括，yy表示对应的判断依据，<sep0>和<sep1>为分隔符。
                             请重新输出结果，确保输出完整内容，且结果格式与模板格式一致。'''
+                self.record_retry('omitted_section')
                 print("第{}类分析存在回答遗漏错误，将重新进行分析".format(cluster))
                 continue
 
@@ -99,6 +141,7 @@ class TextPreClassificationAgent:
                             回答模板格式如下：体验问题：1.xx<sep0>2.xx<sep0>3.xx<sep0>...<sep0>N.xx<sep1>推理原因：1.yy<sep0>2.yy<sep0>3.yy<sep0>...<sep0>N.yy
                             其中xx表示简要词汇概括，yy表示对应的判断依据，<sep0>和<sep1>为分隔符。
                             请重新输出结果，确保输出结果的分隔符与模板格式一致。'''
+                self.record_retry('separator_error')
                 print("第{}类分析存在<sep1>分隔符错误，将重新进行分析".format(cluster))
                 continue
 
@@ -108,6 +151,7 @@ class TextPreClassificationAgent:
                             回答模板格式如下：体验问题：1.xx<sep0>2.xx<sep0>3.xx<sep0>...<sep0>N.xx<sep1>推理原因：1.yy<sep0>2.yy<sep0>3.yy<sep0>...<sep0>N.yy
                             其中xx表示简要词汇概括，yy表示对应的判断依据，<sep0>和<sep1>为分隔符。
                             请重新输出结果，确保输出体验问题和推理原因的分条列点数量一致。'''
+                self.record_retry('count_mismatch')
                 print("第{}类分析存在数据量不一致或<sep0>分隔符错误，将重新进行分析".format(cluster))
                 continue
 
@@ -115,9 +159,5 @@ class TextPreClassificationAgent:
                 error_answer = False
 
         answer = re.findall(r'体验问题：(.*)<sep1>.*推理原因：(.*)', response, re.S)
-        self.pre_classified_summary.loc[self.pre_classified_summary['cluster'] == cluster, '体验问题'] = ','.join(
-            answer[0][0].split('<sep0>'))
-        self.pre_classified_summary.loc[self.pre_classified_summary['cluster'] == cluster, '推理原因'] = ','.join(
-            answer[0][1].split('<sep0>'))
 
-        return self.pre_classified_summary
+        return ','.join(answer[0][0].split('<sep0>')), ','.join(answer[0][1].split('<sep0>'))
@@ -1,104 +1,167 @@
+import asyncio
 import re
+from collections import Counter
 
-import numpy as np
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core import CancellationToken
 from tqdm.asyncio import tqdm_asyncio
 
-from .utils import get_classified_summary
+from .map_reduce import AgentPool, chunk_by_tokens, map_reduce
+from .metrics import Metrics, timed_stage
+from .model_client import get_model_client, get_model_context
+from .sampling import get_representative_texts
+from .utils import chinese_preprocess_batch, get_classified_summary
 
 
 class TextSummaryAgent:
-    def __init__(self, base_url, api_key, model, domain, question_type):
+    def __init__(self, base_url, api_key, model, domain, question_type, cache_store=None, stateless=True,
+                 buffer_size=None, model_client=None, map_reduce=False, chunk_token_budget=2000, reduce_fan_out=4,
+                 reduce_max_depth=3, max_chunks=16, metrics=None):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
         self.domain = domain
         self.question_type = question_type
-        self.model_client = OpenAIChatCompletionClient(
-            base_url=self.base_url,
-            api_key=self.api_key,
-            model=self.model,
-            temperature=0,
-            model_info={
-                "vision": True,
-                "function_calling": True,
-                "json_output": False,
-                "family": ModelFamily.R1,
-                "structured_output": True,
-            },
-        )
-        self.text_summary_agent = AssistantAgent(
+        self.cache_store = cache_store
+        self.stateless = stateless
+        self.buffer_size = buffer_size
+        self.retry_stats = Counter()
+        self.metrics = metrics or Metrics()
+        self.map_reduce = map_reduce
+        self.chunk_token_budget = chunk_token_budget
+        self.reduce_fan_out = reduce_fan_out
+        self.reduce_max_depth = reduce_max_depth
+        self.max_chunks = max_chunks
+        self.model_client = model_client or get_model_client(self.base_url, self.api_key, self.model,
+                                                             self.cache_store)
+        self.system_message = """你是一个{domain}领域{question_type}问题分析的专家，给定{question_type}问题和文本内容，请推理用户在{domain}领域存在该{question_type}问题背后的原因，输出结果为推理原因，其中推理原因为分条列点回答对应的判断依据。
+                                    回答模板格式如下：推理原因：1.yy<sep>2.yy<sep>3.yy<sep>...<sep>N.yy
+                                    其中yy表示对应的判断依据，<sep>为分隔符。""".format(domain=self.domain, question_type=self.question_type)
+        # map-reduce模式下合并各文本块推理原因时使用的提示
+        self.reduce_prompt = "\n以下为该问题相关文本分块分析得到的多组推理原因，请合并相同或相似的原因后重新输出推理原因："
+        self.text_summary_agent = self.get_text_summary_agent()
+
+    def get_text_summary_agent(self):
+        return AssistantAgent(
             name="text_summary_agent",
             model_client=self.model_client,
-            system_message="""你是一个{domain}领域{question_type}问题分析的专家，给定{question_type}问题和文本内容，请推理用户在{domain}领域存在该{question_type}问题背后的原因，输出结果为推理原因，其中推理原因为分条列点回答对应的判断依据。
-                                    回答模板格式如下：推理原因：1.yy<sep>2.yy<sep>3.yy<sep>...<sep>N.yy
-                                    其中yy表示对应的判断依据，<sep>为分隔符。""".format(domain=self.domain, question_type=self.question_type),
+            model_context=get_model_context(self.buffer_size),
+            system_message=self.system_message,
         )
 
-    async def batch_run(self, classified_df, content_col, sentiment_col=None, classified_col='class'):
+    def record_retry(self, retry_type):
+        self.retry_stats[retry_type] += 1
+        self.metrics.record_retry(self.text_summary_agent.name, retry_type)
+
+    @timed_stage('text_summary')
+    async def batch_run(self, classified_df, content_col, sentiment_col=None, classified_col='class',
+                        max_concurrency=1, checkpoint=None, classified_summary=None, tfidf=None,
+                        sample_token_budget=8000, max_text_tokens=200, n_jobs=1, tokenize_cache=None):
         self.classified_df, self.classified_summary = get_classified_summary(classified_df, sentiment_col, classified_col)
+        if classified_summary is not None:
+            # 增量模式下使用按累计数量汇总的结果，只对推理原因为空的问题标签进行分析
+            self.classified_summary = classified_summary.copy()
+
+        if checkpoint is not None:
+            done = checkpoint.load_rows('text_summary')
+            restored = self.classified_summary.index.isin(list(done.keys()))
+            self.classified_summary.loc[restored, '推理原因'] = self.classified_summary.index[restored].map(done)
+        pending_index = self.classified_summary.index[self.classified_summary['推理原因'] == '']
+        class_queue = asyncio.Queue()
+        for i in pending_index:
+            class_queue.put_nowait(i)
+
+        # 各标签的分析相互独立，可并发请求；每个标签只选取最靠近标签中心的代表文本，提示词长度受token预算约束。
+        # map-reduce模式下由分块控制每次请求的长度，每个标签的代表文本放宽至max_chunks个文本块，
+        # max_chunks为None时标签下去重后的全部文本均参与分析
+        class_texts = {}
+        if len(pending_index):
+            contents = self.classified_df[content_col].to_numpy()
+            if 'corpus' in self.classified_df.columns:
+                corpus = self.classified_df['corpus']
+            else:
+                corpus = chinese_preprocess_batch(contents, n_jobs=n_jobs, tokenize_cache=tokenize_cache)
+            if tfidf is None:
+                from sklearn.feature_extraction.text import TfidfVectorizer
+
+                tfidf = TfidfVectorizer(max_features=1000).fit(corpus)
+            X = tfidf.transform(corpus)
+            class_positions = self.classified_df.groupby(classified_col, observed=True).indices
+        for i in pending_index:
+            label = self.classified_summary.loc[i, classified_col]
+            positions = class_positions[label]
+            if not self.map_reduce:
+                label_token_budget, max_texts = sample_token_budget, 500
+            elif self.max_chunks is not None:
+                label_token_budget, max_texts = self.max_chunks * self.chunk_token_budget, None
+            else:
+                label_token_budget, max_texts = None, None
+            class_texts[label] = get_representative_texts(contents[positions], X[positions], None,
+                                                          label_token_budget, max_texts, max_text_tokens)
+            if len(class_texts[label]) < len(positions):
+                print("第{}类分析，已从{}条文本中选取最具代表性的{}条".format(i, len(positions), len(class_texts[label])))
+        answers = {}
 
-        start_tag = self.classified_summary[self.classified_summary['推理原因'] == ''].index.min()
-        end_tag = self.classified_summary[self.classified_summary['推理原因'] == ''].index.max() + 1
-        if not np.isnan(start_tag):
-            index_list = list(range(start_tag, end_tag))
+        pbar = tqdm_asyncio(total=class_queue.qsize(), desc="text summary complete progress")
 
-        pbar = tqdm_asyncio(total=len(self.classified_summary[self.classified_summary['推理原因'] == '']),
-                            desc="text summary complete progress")
-        for i in index_list:
-            await self.run(self.classified_df, self.classified_summary, i, content_col, classified_col)
+        def complete(i):
             pbar.update(1)
+            if checkpoint is not None:
+                checkpoint.save_rows('text_summary', [i], [answers[i]])
+
+        async def worker(agent):
+            while not class_queue.empty():
+                i = class_queue.get_nowait()
+                label = self.classified_summary.loc[i, classified_col]
+                answers[i] = await self.run(class_texts[label], label, i, agent)
+                complete(i)
+
+        async def summarize_class(i, agent_pool):
+            label = self.classified_summary.loc[i, classified_col]
+            answers[i] = await map_reduce(
+                class_texts[label],
+                lambda texts: agent_pool.run(self.run, texts, label, i),
+                lambda partials: agent_pool.run(self.run, partials, label, i, content_prompt=self.reduce_prompt),
+                self.chunk_token_budget, self.reduce_fan_out, self.reduce_max_depth)
+            complete(i)
+
+        if self.map_reduce:
+            # map-reduce模式下所有标签的文本块及合并请求共享max_concurrency个agent，大标签的文本块同样并发处理
+            num_chunks = sum(len(chunk_by_tokens(texts, self.chunk_token_budget)) for texts in class_texts.values())
+            num_workers = max(1, min(max_concurrency, num_chunks))
+            agents = [self.text_summary_agent] + [self.get_text_summary_agent() for _ in range(num_workers - 1)]
+            agent_pool = AgentPool(agents)
+            await asyncio.gather(*[summarize_class(i, agent_pool) for i in pending_index])
+        else:
+            num_workers = max(1, min(max_concurrency, class_queue.qsize()))
+            agents = [self.text_summary_agent] + [self.get_text_summary_agent() for _ in range(num_workers - 1)]
+            await asyncio.gather(*[worker(agent) for agent in agents])
 
         pbar.close()
         print("text summary completion completed")
 
+        for i, answer in answers.items():
+            self.classified_summary.loc[i, "推理原因"] = answer
+
         return self.classified_summary
 
-    async def run(self, classified_df, classified_summary, i, content_col, classified_col):
-        self.classified_df = classified_df.copy()
-        self.classified_summary = classified_summary.copy()
+    async def run(self, texts, label, i, agent=None, content_prompt=None):
+        agent = agent or self.text_summary_agent
+        if self.stateless:
+            await agent.on_reset(CancellationToken())
         error_answer = True
         omit_prompt = ''
 
+        task_message = (
+                "体验问题为："
+                + label
+                + "。"
+                + (content_prompt or "\n相关文本内容为：")
+                + "\n".join(texts)
+        )
+
         while error_answer:
-            if (
-                    len(
-                        self.classified_df[
-                            self.classified_df[classified_col]
-                            == self.classified_summary.loc[i, classified_col]
-                        ]
-                    )
-                    > 500
-            ):
-                task_message = (
-                        "体验问题为："
-                        + self.classified_summary.loc[i, classified_col]
-                        + "。"
-                        + "\n相关文本内容为："
-                        + "\n".join(
-                    self.classified_df[
-                        self.classified_df[classified_col]
-                        == self.classified_summary.loc[i, classified_col]
-                        ][content_col].sample(n=500, random_state=1, replace=False)
-                )
-                )
-                print("第{}类分析，文本量过大，已抽样500条".format(i))
-            else:
-                task_message = (
-                        "体验问题为："
-                        + self.classified_summary.loc[i, classified_col]
-                        + "。"
-                        + "\n相关文本内容为："
-                        + "\n".join(
-                    self.classified_df[
-                        self.classified_df[classified_col]
-                        == self.classified_summary.loc[i, classified_col]
-                        ][content_col]
-                )
-                )
-            result = await self.text_summary_agent.run(task='\n\n'.join([omit_prompt, task_message]))
+            result = await self.metrics.run_agent(agent, task='\n\n'.join([omit_prompt, task_message]))
 
             response = result.messages[-1].content
 
@@ -107,12 +170,12 @@ class TextSummaryAgent:
                         回答模板格式如下：推理原因：1.yy<sep>2.yy<sep>3.yy<sep>...<sep>N.yy
                         其中yy表示对应的判断依据，<sep>为分隔符。
                         请重新输出结果，确保输出完整内容，且结果格式与模板格式一致。'''
+                self.record_retry('omitted_section')
                 print("第{}类分析存在回答遗漏错误，将重新进行分析".format(i + 1))
                 continue
             else:
                 error_answer = False
 
         answer = re.findall(r"推理原因：(.*)", response, re.S)
-        self.classified_summary.loc[i, "推理原因"] = ','.join(answer[0].strip().split('<sep>'))
 
-        return self.classified_summary
+        return ','.join(answer[0].strip().split('<sep>'))
@@ -0,0 +1,160 @@
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import normalize
+
+
+def get_polarity(scores):
+    # 与系统提示词一致：[0,3]为负向、(3,6]为中性、(6,10]为正向
+    return np.digitize(scores, [3, 6], right=True)
+
+
+class LocalTriage:
+    # 本地模型分流的公共部分：种子样本抽取、留出样本评估及分流统计
+    task_name = ''
+
+    def __init__(self, seed_size=1000, holdout_ratio=0.2, random_state=1):
+        self.seed_size = seed_size
+        self.holdout_ratio = holdout_ratio
+        self.random_state = random_state
+        self.fitted = False
+        self.num_local = 0
+        self.num_llm = 0
+        self.holdout_agreement = None
+        self.holdout_coverage = None
+
+    def sample_seed(self, positions):
+        # 从待分析文本中随机抽取种子样本，先由大模型分析作为本地模型的训练数据
+        if len(positions) <= self.seed_size:
+            return positions
+        rng = np.random.default_rng(self.random_state)
+        return np.sort(rng.choice(positions, size=self.seed_size, replace=False))
+
+    def get_holdout(self, num_rows):
+        rng = np.random.default_rng(self.random_state)
+        return rng.random(num_rows) < self.holdout_ratio
+
+    def evaluate(self, predicted, confident, expected):
+        self.holdout_coverage = confident.mean()
+        if confident.any():
+            self.holdout_agreement = (predicted[confident] == expected[confident]).mean()
+
+    def report(self):
+        total = self.num_local + self.num_llm
+        print("本地分流：{}条文本由本地模型直接{}，{}条文本交由大模型分析，本地处理占比{:.2%}".format(
+            self.num_local, self.task_name, self.num_llm, self.num_local / total if total else 0.0))
+        if self.holdout_coverage is not None:
+            print("留出样本中本地模型高置信度预测占比{:.2%}，与大模型结果的一致率为{}".format(
+                self.holdout_coverage,
+                'N/A' if self.holdout_agreement is None else '{:.2%}'.format(self.holdout_agreement)))
+
+
+class SentimentTriage(LocalTriage):
+    task_name = '打分'
+
+    def __init__(self, confidence=0.9, seed_size=1000, holdout_ratio=0.2, random_state=1):
+        super().__init__(seed_size, holdout_ratio, random_state)
+        self.confidence = confidence
+
+    def get_model(self):
+        # 字符n-gram保留否定词等停用词信息，对情感倾向判断更稳定
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(1, 2), max_features=50000)
+        return vectorizer, LogisticRegression(max_iter=1000)
+
+    def fit(self, texts, scores):
+        scores = np.asarray(scores, dtype='float64')
+        valid = ~np.isnan(scores)
+        texts = np.asarray(texts, dtype=object)[valid]
+        scores = scores[valid]
+        polarity = get_polarity(scores)
+        self.fitted = True
+        self.classes = np.unique(polarity)
+        if len(self.classes) < 2:
+            # 种子样本只有一种情感倾向时无法训练，所有文本仍交由大模型分析
+            print("本地分流的训练样本只包含一种情感倾向，将全部交由大模型分析")
+            return self
+
+        # 先在留出样本上评估高置信度预测与大模型结果的一致率，再使用全部样本训练
+        holdout = self.get_holdout(len(texts))
+        if holdout.any() and len(np.unique(polarity[~holdout])) == len(self.classes):
+            vectorizer, model = self.get_model()
+            model.fit(vectorizer.fit_transform(texts[~holdout]), polarity[~holdout])
+            probabilities = model.predict_proba(vectorizer.transform(texts[holdout]))
+            self.evaluate(model.classes_[probabilities.argmax(axis=1)],
+                          probabilities.max(axis=1) >= self.confidence, polarity[holdout])
+
+        self.vectorizer, self.model = self.get_model()
+        self.model.fit(self.vectorizer.fit_transform(texts), polarity)
+        # 本地模型只判断情感倾向，情感分取该倾向下大模型打分的中位数
+        self.polarity_scores = {label: str(int(np.median(scores[polarity == label]))) for label in self.classes}
+
+        return self
+
+    def predict(self, texts):
+        if len(self.classes) < 2 or not len(texts):
+            return np.full(len(texts), '', dtype=object), np.zeros(len(texts), dtype=bool)
+
+        probabilities = self.model.predict_proba(self.vectorizer.transform(texts))
+        predicted = self.model.classes_[probabilities.argmax(axis=1)]
+        scores = np.array([self.polarity_scores[label] for label in predicted], dtype=object)
+
+        return scores, probabilities.max(axis=1) >= self.confidence
+
+
+class ClassificationTriage(LocalTriage):
+    task_name = '分类'
+
+    def __init__(self, min_margin=0.05, min_similarity=0.05, seed_size=500, holdout_ratio=0.2, random_state=1,
+                 vectorizer=None, no_match_label='其他问题'):
+        super().__init__(seed_size, holdout_ratio, random_state)
+        self.min_margin = min_margin
+        self.min_similarity = min_similarity
+        # 默认复用预分类阶段拟合的TF-IDF，未提供时在种子样本的分词结果上拟合
+        self.vectorizer = vectorizer
+        self.no_match_label = no_match_label
+
+    def get_centroids(self, features, labels):
+        classes = np.unique(labels)
+        centroids = np.vstack([np.asarray(features[labels == label].mean(axis=0)) for label in classes])
+        return classes, normalize(centroids)
+
+    def assign(self, features, classes, centroids):
+        # 按与各标签中心的余弦相似度分配标签，最高相似度过低时归入无匹配标签，与次高相似度差距过小时交由大模型
+        similarities = np.asarray(normalize(features) @ centroids.T)
+        order = np.argsort(-similarities, axis=1)
+        best = similarities[np.arange(len(similarities)), order[:, 0]]
+        if len(classes) > 1:
+            margin = best - similarities[np.arange(len(similarities)), order[:, 1]]
+        else:
+            margin = np.full(len(similarities), np.inf)
+        labels = classes[order[:, 0]].astype(object)
+        no_match = best < self.min_similarity
+        labels[no_match] = self.no_match_label
+
+        return labels, no_match | (margin >= self.min_margin)
+
+    def fit(self, corpus, labels):
+        # 种子样本中分类失败的文本没有标签，不参与训练
+        valid = np.array([label is not None for label in labels], dtype=bool)
+        corpus = np.asarray(corpus, dtype=object)[valid]
+        labels = np.asarray(labels, dtype=object)[valid]
+        self.fitted = True
+        if self.vectorizer is None:
+            self.vectorizer = TfidfVectorizer(max_features=1000).fit(corpus)
+        features = self.vectorizer.transform(corpus)
+
+        holdout = self.get_holdout(len(corpus))
+        if holdout.any() and (~holdout).any():
+            classes, centroids = self.get_centroids(features[~holdout], labels[~holdout])
+            predicted, confident = self.assign(features[holdout], classes, centroids)
+            self.evaluate(predicted, confident, labels[holdout])
+
+        self.classes, self.centroids = self.get_centroids(features, labels)
+
+        return self
+
+    def predict(self, corpus):
+        if not len(corpus):
+            return np.full(0, '', dtype=object), np.zeros(0, dtype=bool)
+
+        return self.assign(self.vectorizer.transform(corpus), self.classes, self.centroids)
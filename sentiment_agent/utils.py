@@ -1,11 +1,15 @@
-import jieba.posseg as pseg
-import matplotlib.pyplot as plt
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
-from scipy.optimize import curve_fit
-from sklearn.cluster import KMeans
-from sklearn.feature_extraction.text import TfidfVectorizer
-import os
+
+from .metrics import timed_step
+
+# jieba词典缓存文件路径，设置后分词时从该文件加载预先构建的词典，文件不存在时构建后写入
+JIEBA_CACHE_ENV = 'SENTIMENT_AGENT_JIEBA_CACHE'
 
 
 def get_simulated_data_by_llm():
@@ -15,17 +19,38 @@ def get_simulated_data_by_llm():
     return df
 
 
+@lru_cache(maxsize=1)
 def get_stop_words():
 
     with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "stop_words/stop_words.txt"), 'r', encoding='utf-8') as file:
-        # 读取全部内容
-        stop_words_set = set(file.read().split('\n'))
+        # 读取全部内容，停用词表只在首次调用时加载，之后复用同一集合
+        stop_words_set = frozenset(file.read().split('\n'))
     return stop_words_set
 
 
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    # jieba在首次分词时才导入并加载词典，避免import sentiment_agent时的启动开销
+    import jieba
+    import jieba.posseg as pseg
+
+    cache_file = os.environ.get(JIEBA_CACHE_ENV)
+    if cache_file:
+        jieba.dt.cache_file = os.path.abspath(cache_file)
+    jieba.dt.initialize()
+    return pseg
+
+
+def build_jieba_cache(cache_file):
+    # 预先构建jieba词典缓存，并通过环境变量传递给当前进程及之后创建的分词子进程
+    os.environ[JIEBA_CACHE_ENV] = os.path.abspath(cache_file)
+    get_tokenizer.cache_clear()
+    get_tokenizer()
+
+
 def chinese_preprocess(text):
     stop_words_set = get_stop_words()
-    words = pseg.lcut(text)
+    words = get_tokenizer().lcut(text)
 
     return " ".join(
         [
@@ -38,6 +63,45 @@ def chinese_preprocess(text):
     )
 
 
+def resolve_n_jobs(n_jobs):
+    # None及负数统一解析为实际进程数，分词与肘部法搜索中含义一致：None与-1为全部CPU，-2为全部CPU减1，以此类推
+    if n_jobs is None:
+        n_jobs = -1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def chinese_preprocess_batch(texts, n_jobs=1, chunksize=1000, tokenize_cache=None):
+    n_jobs = resolve_n_jobs(n_jobs)
+    texts = list(texts)
+    corpus = [None] * len(texts)
+
+    # 以文本内容的哈希值作为缓存键，已分词的文本直接复用缓存结果
+    keys = None
+    if tokenize_cache is not None:
+        keys = [hashlib.md5(text.encode('utf-8')).hexdigest() for text in texts]
+        corpus = [tokenize_cache.get(key) for key in keys]
+    missing_index = [i for i, words in enumerate(corpus) if words is None]
+    # 重复文本只分词一次
+    missing_texts = list(dict.fromkeys(texts[i] for i in missing_index))
+
+    if n_jobs != 1 and len(missing_texts) > chunksize:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            missing_corpus = list(executor.map(chinese_preprocess, missing_texts, chunksize=chunksize))
+    else:
+        missing_corpus = [chinese_preprocess(text) for text in missing_texts]
+
+    missing_corpus = dict(zip(missing_texts, missing_corpus))
+    for i in missing_index:
+        words = missing_corpus[texts[i]]
+        corpus[i] = words
+        if tokenize_cache is not None:
+            tokenize_cache[keys[i]] = words
+
+    return corpus
+
+
 def get_top_keywords(kmeans, tfidf, n_clusters, n_keywords=10):
     centroid = kmeans.cluster_centers_[n_clusters]
     feature_names = tfidf.get_feature_names_out()
@@ -45,37 +109,36 @@ def get_top_keywords(kmeans, tfidf, n_clusters, n_keywords=10):
     return [feature_names[i] for i in top_indices]
 
 
+def get_all_top_keywords(kmeans, tfidf, n_keywords=10):
+    # 对所有簇中心一次性取权重最大的n_keywords个特征，argpartition避免对整行特征排序
+    centroids = kmeans.cluster_centers_
+    feature_names = tfidf.get_feature_names_out()
+    n_keywords = min(n_keywords, centroids.shape[1])
+    top_indices = np.argpartition(centroids, -n_keywords, axis=1)[:, -n_keywords:]
+    top_order = np.argsort(-np.take_along_axis(centroids, top_indices, axis=1), axis=1, kind='stable')
+    top_indices = np.take_along_axis(top_indices, top_order, axis=1)
+    return feature_names[top_indices]
+
+
 def get_pre_classified_summary(kmeans, tfidf, pre_classified_df, n_clusters, content_col, sentiment_col):
+    clusters = np.arange(n_clusters)
+    cluster_groups = pre_classified_df.groupby("cluster", sort=True)
+    comment_cnt = cluster_groups.size().reindex(clusters, fill_value=0)
+    sample_cases = cluster_groups.head(5).groupby("cluster")[content_col].agg(
+        lambda sample_case: "\n".join(sample_case.astype(str))).reindex(clusters, fill_value='')
+
     pre_classified_summary = pd.DataFrame(
         {
-            "cluster": np.arange(n_clusters),
-            "keywords": [
-                ", ".join(get_top_keywords(kmeans, tfidf, n_clusters=i)) for i in range(n_clusters)
-            ],
-            "sample_cases": [
-                "\n".join(
-                    [
-                        f"{sample_case}"
-                        for sample_case in pre_classified_df[pre_classified_df["cluster"] == i][content_col].to_list()[:5]
-                    ]
-                )
-                for i in range(n_clusters)
-            ],
-            "comment_cnt": [
-                pre_classified_df[pre_classified_df["cluster"] == i].shape[0]
-                for i in range(n_clusters)
-            ],
-            "comment_pct": [
-                pre_classified_df[pre_classified_df["cluster"] == i].shape[0] / len(pre_classified_df)
-                for i in range(n_clusters)
-            ],
+            "cluster": clusters,
+            "keywords": [", ".join(keywords) for keywords in get_all_top_keywords(kmeans, tfidf)],
+            "sample_cases": sample_cases.to_numpy(),
+            "comment_cnt": comment_cnt.to_numpy(),
+            "comment_pct": comment_cnt.to_numpy() / len(pre_classified_df),
         }
     )
     if sentiment_col is not None:
-        pre_classified_summary[sentiment_col] = [
-                pre_classified_df[pre_classified_df["cluster"] == i][sentiment_col].astype('float64').mean()
-                for i in range(n_clusters)
-            ]
+        pre_classified_summary[sentiment_col] = pre_classified_df[sentiment_col].astype('float64').groupby(
+            pre_classified_df["cluster"]).mean().reindex(clusters).to_numpy()
     pre_classified_summary[['体验问题', '推理原因']] = ''
 
     return pre_classified_summary
@@ -86,6 +149,8 @@ def polynomial(x, a, b):
 
 
 def detect_elbow_k_residual(k_values, inertia_values):
+    from scipy.optimize import curve_fit
+
     coef, _ = curve_fit(polynomial, np.array(k_values)[[0, -1]], np.array(inertia_values)[[0, -1]])
     fitted_values = polynomial(k_values, *coef)
     residuals = np.abs(inertia_values - fitted_values)
@@ -93,51 +158,142 @@ def detect_elbow_k_residual(k_values, inertia_values):
     return k_values[peak_index], coef
 
 
-def pre_classified_fit(pre_classified_df, content_col, pre_cluster_num=20, sentiment_col=None):
+def fit_kmeans(X, n_clusters, minibatch=False):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if minibatch:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=1, n_init=3)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=1)
+    kmeans.fit(X)
+    return kmeans
+
+
+def elbow_search(X, pre_cluster_num=20, method='full', minibatch=False, n_jobs=1, coarse_step=4):
+    from joblib import Parallel, delayed
+
+    n_jobs = resolve_n_jobs(n_jobs)
+    # 计算不同簇数下的SSE，各k值的拟合相互独立，可并行执行，拟合结果保留以便复用
+    kmeans_models = {}
+
+    def fit_k_values(k_values):
+        k_values = [k for k in k_values if k not in kmeans_models]
+        models = Parallel(n_jobs=n_jobs)(delayed(fit_kmeans)(X, k, minibatch) for k in k_values)
+        kmeans_models.update(zip(k_values, models))
+
+    def detect_elbow():
+        k_values = np.array(sorted(kmeans_models))
+        inertia_values = np.array([kmeans_models[k].inertia_ for k in k_values])  # inertia_表示SSE
+        elbow_k, coef = detect_elbow_k_residual(k_values, inertia_values)
+        return int(elbow_k), coef, k_values, inertia_values
+
+    if method == 'coarse_to_fine':
+        # 先按coarse_step间隔粗略搜索拐点，再只在拐点附近逐个拟合，拐点移动时继续在新拐点附近拟合
+        fit_k_values(list(range(1, pre_cluster_num + 1, coarse_step)) + [pre_cluster_num])
+        while True:
+            elbow_k, coef, k_values, inertia_values = detect_elbow()
+            window = range(max(1, elbow_k - coarse_step + 1), min(pre_cluster_num, elbow_k + coarse_step - 1) + 1)
+            if all(k in kmeans_models for k in window):
+                break
+            fit_k_values(window)
+    elif method == 'full':
+        fit_k_values(range(1, pre_cluster_num + 1))
+    else:
+        raise ValueError("method must be 'full' or 'coarse_to_fine', got {}".format(method))
+
+    elbow_k, coef, k_values, inertia_values = detect_elbow()
+
+    return elbow_k, coef, k_values, inertia_values, kmeans_models
+
+
+def save_elbow_plot(plot_path, k_values, inertia_values, coef, elbow_k):
+    # 直接使用Figure对象保存，不经过pyplot，无图形界面的环境及非主线程中同样可用
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    ax = figure.subplots()
+    ax.plot(k_values, inertia_values, 'bo-', label='raw data')
+    ax.plot(k_values, polynomial(k_values, *coef), 'r--', label='fitting curve')
+    ax.plot(elbow_k, polynomial(elbow_k, *coef), 'go', label='Detected turning point')
+    ax.set_xlabel('n_clusters (k)')
+    ax.set_ylabel('SSE')
+    ax.legend()
+    figure.savefig(plot_path)
+
+
+def fit_tfidf(texts, n_jobs=1, tokenize_cache=None, metrics=None):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    with timed_step(metrics, 'tokenize'):
+        corpus = chinese_preprocess_batch(texts, n_jobs=n_jobs, tokenize_cache=tokenize_cache)
+    with timed_step(metrics, 'tfidf'):
+        return TfidfVectorizer(max_features=1000).fit(corpus)
+
+
+def pre_classified_fit(pre_classified_df, content_col, pre_cluster_num=20, sentiment_col=None, n_jobs=1,
+                       tokenize_cache=None, elbow_method='full', minibatch=False, plot_path=None, return_models=False,
+                       metrics=None, tfidf=None):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
     pre_classified_df = pre_classified_df.copy()
-    pre_classified_df["corpus"] = pre_classified_df[content_col].map(chinese_preprocess)
+    with timed_step(metrics, 'tokenize'):
+        pre_classified_df["corpus"] = chinese_preprocess_batch(pre_classified_df[content_col], n_jobs=n_jobs,
+                                                               tokenize_cache=tokenize_cache)
 
     # TF-IDF向量化
-    tfidf = TfidfVectorizer(max_features=1000)
-    X = tfidf.fit_transform(pre_classified_df["corpus"])
+    with timed_step(metrics, 'tfidf'):
+        if tfidf is None:
+            tfidf = TfidfVectorizer(max_features=1000)
+            X = tfidf.fit_transform(pre_classified_df["corpus"])
+        else:
+            # 传入已拟合的TF-IDF时只做转换，多问题类型模式下各问题类型共用同一词表
+            X = tfidf.transform(pre_classified_df["corpus"])
     # 计算不同簇数下的SSE
-    inertia_values = []
-    k_values = range(1, pre_cluster_num + 1)
-    for k in k_values:
-        kmeans = KMeans(n_clusters=k, random_state=1)
-        kmeans.fit(X)
-        inertia_values.append(kmeans.inertia_)  # inertia_表示SSE
-    
-    elbow_k_residual, coef = detect_elbow_k_residual(k_values, inertia_values)
+    with timed_step(metrics, 'elbow_search'):
+        elbow_k_residual, coef, k_values, inertia_values, kmeans_models = elbow_search(X, pre_cluster_num,
+                                                                                       elbow_method, minibatch, n_jobs)
     print(f"基于残差分析检测到的拐点k={elbow_k_residual}对应的SSE={polynomial(elbow_k_residual, *coef)}")
 
-    # 可视化结果
-    plt.plot(k_values, inertia_values, 'bo-', label='raw data')
-    plt.plot(k_values, polynomial(k_values, *coef), 'r--', label='fitting curve')
-    plt.plot(elbow_k_residual, polynomial(elbow_k_residual, *coef), 'go', label='Detected turning point')
-    plt.xlabel('n_clusters (k)')
-    plt.ylabel('SSE')
-    plt.legend()
-    plt.show()
+    # 可视化结果，默认不绘图，指定plot_path时保存到文件
+    if plot_path is not None:
+        save_elbow_plot(plot_path, k_values, inertia_values, coef, elbow_k_residual)
 
-    # KMeans聚类
-    n_clusters = elbow_k_residual
-    kmeans = KMeans(n_clusters=n_clusters, random_state=1)
-    pre_classified_df['cluster'] = kmeans.fit_predict(X)
+    # KMeans聚类，直接复用拐点k值在搜索阶段的拟合结果，该步骤耗时只包含簇分配及各簇关键词汇总
+    with timed_step(metrics, 'kmeans'):
+        n_clusters = elbow_k_residual
+        kmeans = kmeans_models[n_clusters]
+        pre_classified_df['cluster'] = kmeans.labels_
 
-    pre_classified_summary = get_pre_classified_summary(kmeans, tfidf, pre_classified_df, n_clusters, content_col, sentiment_col)
+        pre_classified_summary = get_pre_classified_summary(kmeans, tfidf, pre_classified_df, n_clusters, content_col,
+                                                            sentiment_col)
 
+    if return_models:
+        return pre_classified_df, pre_classified_summary, tfidf, kmeans
     return pre_classified_df, pre_classified_summary
 
 
+def pre_classified_predict(pre_classified_df, content_col, tfidf, kmeans, n_jobs=1, tokenize_cache=None):
+    # 使用已拟合的TF-IDF与KMeans为新到达的文本分配预分类簇，不重新拟合
+    pre_classified_df = pre_classified_df.copy()
+    pre_classified_df["corpus"] = chinese_preprocess_batch(pre_classified_df[content_col], n_jobs=n_jobs,
+                                                           tokenize_cache=tokenize_cache)
+    pre_classified_df['cluster'] = kmeans.predict(tfidf.transform(pre_classified_df["corpus"]))
+
+    return pre_classified_df
+
+
 def get_classified_summary(classified_df, sentiment_col, classified_col):
     classified_df = classified_df.copy()
-    classified_summary = classified_df.groupby(by=classified_col)[[classified_col]].agg({classified_col: 'count'}).rename(
-        columns={classified_col: 'count'})
-    classified_summary['percentage'] = classified_summary['count'] / len(classified_df)
+    classified_summary = classified_df.groupby(by=classified_col, observed=True)[[classified_col]].agg(
+        {classified_col: 'count'}).rename(columns={classified_col: 'count'})
+    # 分类失败的文本标签为缺失值，不计入各标签的数量及占比
+    classified_summary['percentage'] = classified_summary['count'] / classified_summary['count'].sum()
     if sentiment_col is not None:
         classified_df[sentiment_col] = classified_df[sentiment_col].astype('float64')
-        classified_summary[sentiment_col] = classified_df.groupby(by=classified_col)[sentiment_col].mean()
+        classified_summary[sentiment_col] = classified_df.groupby(by=classified_col, observed=True)[
+            sentiment_col].mean()
     classified_summary = classified_summary.reset_index()
+    # 汇总结果行数很少，标签转为字符串便于拼接提示词
+    classified_summary[classified_col] = classified_summary[classified_col].astype(object)
     classified_summary['推理原因'] = ''
     return classified_df, classified_summary